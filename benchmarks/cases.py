@@ -0,0 +1,119 @@
+import time
+
+import celery
+from django.core import mail
+from django.core.mail import EmailMultiAlternatives
+from django.test.utils import override_settings
+
+from djcelery_email import tasks
+from djcelery_email.backends import CeleryEmailBackend
+from djcelery_email.utils import dict_to_email, email_to_dict
+
+from benchmarks.smtp import FakeSMTPServer
+
+KB = 1024
+MB = 1024 * KB
+
+
+def make_message(body_size, attachment_size=0, alternatives=False, index=0):
+    msg = EmailMultiAlternatives('Benchmark %d' % index, 'x' * body_size, 'from@example.com',
+                                 ['to%d@example.com' % index])
+    if alternatives:
+        msg.attach_alternative('<p>%s</p>' % ('x' * body_size), 'text/html')
+    if attachment_size:
+        msg.attach('file.bin', b'\0' * attachment_size, 'application/octet-stream')
+    return msg
+
+
+def bench(name, func, number, repeat=3, **params):
+    """
+    Runs 'func' 'number' times, 'repeat' times over, and returns the timings
+    of the fastest round.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        mail.outbox = []
+    result = {
+        'name': name,
+        'params': params,
+        'number': number,
+        'seconds': best,
+        'us_per_op': best / number * 1e6,
+        'ops_per_second': number / best if best else None,
+    }
+    if 'messages' in params:
+        result['us_per_message'] = result['us_per_op'] / params['messages']
+    return result
+
+
+def roundtrip_cases(full=False):
+    """ email_to_dict followed by dict_to_email, as done for every message. """
+    results = []
+    attachment_sizes = [0, 100 * KB, 5 * MB] if full else [0, 100 * KB]
+    for body_size in [1 * KB, 100 * KB]:
+        for attachment_size in attachment_sizes:
+            for alternatives in [False, True]:
+                msg = make_message(body_size, attachment_size, alternatives)
+                number = 10 if attachment_size >= MB else 200
+                results.append(bench(
+                    'roundtrip', lambda: dict_to_email(email_to_dict(msg)), number,
+                    body_size=body_size, attachment_size=attachment_size, alternatives=alternatives))
+    return results
+
+
+def enqueue_cases(full=False):
+    """ CeleryEmailBackend.send_messages publishing to an in-memory broker. """
+    app = celery.current_app
+    app.conf.broker_url = 'memory://'
+    app.conf.task_always_eager = False
+
+    results = []
+    for count in ([1000, 100000] if full else [1000]):
+        msgs = [make_message(1 * KB, index=i) for i in range(count)]
+        for chunk_size in [10, 100]:
+            for bulk_publish in [False, True]:
+                with override_settings(CELERY_EMAIL_CHUNK_SIZE=chunk_size, CELERY_EMAIL_BULK_PUBLISH=bulk_publish):
+                    results.append(bench(
+                        'enqueue', lambda: CeleryEmailBackend().send_messages(msgs), 1,
+                        messages=count, chunk_size=chunk_size, bulk_publish=bulk_publish))
+                with app.connection() as conn:
+                    conn.default_channel.queue_purge(tasks.send_emails.queue or 'celery')
+    return results
+
+
+def send_cases(full=False):
+    """ The send_emails task run in process, against the locmem backend and a fake SMTP server. """
+    results = []
+    count = 2000 if full else 200
+    for attachment_size in [0, 100 * KB]:
+        messages = [email_to_dict(make_message(1 * KB, attachment_size, index=i)) for i in range(count)]
+        for chunk_size in [1, 10, 100]:
+            chunks = [messages[i:i + chunk_size] for i in range(0, count, chunk_size)]
+
+            def send_all():
+                for chunk in chunks:
+                    tasks.send_emails(chunk)
+
+            with override_settings(CELERY_EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+                results.append(bench('send', send_all, 1, backend='locmem', messages=count,
+                                     chunk_size=chunk_size, attachment_size=attachment_size))
+
+            for precompile_mime in ([False, True] if attachment_size else [False]):
+                with FakeSMTPServer() as server:
+                    with override_settings(CELERY_EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                                           EMAIL_HOST='127.0.0.1', EMAIL_PORT=server.port,
+                                           EMAIL_USE_TLS=False, EMAIL_USE_SSL=False,
+                                           CELERY_EMAIL_PRECOMPILE_MIME=precompile_mime):
+                        results.append(bench('send', send_all, 1, backend='smtp', messages=count,
+                                             chunk_size=chunk_size, attachment_size=attachment_size,
+                                             precompile_mime=precompile_mime))
+    return results
+
+
+def run_all(full=False):
+    return roundtrip_cases(full) + enqueue_cases(full) + send_cases(full)
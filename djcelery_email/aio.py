@@ -0,0 +1,147 @@
+import asyncio
+import smtplib
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.message import sanitize_address
+
+# Make sure our AppConf is loaded properly.
+import djcelery_email.conf  # noqa
+from djcelery_email.circuit import BackendUnavailable
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+
+def recipient_domain(message):
+    recipients = message.recipients()
+    return recipients[0].rpartition('@')[2].lower() if recipients else ''
+
+
+class AsyncSMTPEngine(object):
+    """
+    Sends messages over several concurrent SMTP sessions using aiosmtplib.
+
+    Accepts the same arguments and settings as Django's SMTP EmailBackend.
+    At most CELERY_EMAIL_ASYNC_MAX_SESSIONS sessions are opened, and at most
+    CELERY_EMAIL_ASYNC_MAX_SESSIONS_PER_DOMAIN of them send to the same
+    recipient domain at a time.
+    """
+    def __init__(self, host=None, port=None, username=None, password=None, use_tls=None,
+                 fail_silently=False, use_ssl=None, timeout=None, ssl_keyfile=None, ssl_certfile=None,
+                 **kwargs):
+        if aiosmtplib is None:
+            raise ImproperlyConfigured("CELERY_EMAIL_ENGINE = 'async' requires the aiosmtplib package.")
+        self.host = host or settings.EMAIL_HOST
+        self.port = port or settings.EMAIL_PORT
+        self.username = settings.EMAIL_HOST_USER if username is None else username
+        self.password = settings.EMAIL_HOST_PASSWORD if password is None else password
+        self.use_tls = settings.EMAIL_USE_TLS if use_tls is None else use_tls
+        self.use_ssl = settings.EMAIL_USE_SSL if use_ssl is None else use_ssl
+        self.timeout = settings.EMAIL_TIMEOUT if timeout is None else timeout
+        self.ssl_keyfile = settings.EMAIL_SSL_KEYFILE if ssl_keyfile is None else ssl_keyfile
+        self.ssl_certfile = settings.EMAIL_SSL_CERTFILE if ssl_certfile is None else ssl_certfile
+        if self.use_ssl and self.use_tls:
+            raise ValueError(
+                "EMAIL_USE_TLS/EMAIL_USE_SSL are mutually exclusive, so only set "
+                "one of those settings to True.")
+
+    def send(self, email_messages):
+        """
+        Sends 'email_messages' and returns a list with one entry per message:
+        True if it was sent, False if it had no recipients or the exception
+        raised while sending it. Raises BackendUnavailable if no session to
+        the SMTP server could be opened.
+        """
+        if not email_messages:
+            return []
+        return asyncio.run(self._send_all(email_messages))
+
+    async def _connect(self):
+        smtp = aiosmtplib.SMTP(
+            hostname=self.host, port=self.port, username=self.username or None,
+            password=self.password or None, use_tls=self.use_ssl, start_tls=self.use_tls,
+            timeout=self.timeout, client_key=self.ssl_keyfile, client_cert=self.ssl_certfile,
+        )
+        await smtp.connect()
+        return smtp
+
+    async def _send_all(self, email_messages):
+        results = [False] * len(email_messages)
+        pending = list(enumerate(email_messages))
+        pending.reverse()
+        per_domain = settings.CELERY_EMAIL_ASYNC_MAX_SESSIONS_PER_DOMAIN
+        domain_limits = defaultdict(lambda: asyncio.Semaphore(per_domain))
+        connect_errors = []
+        # the number of sessions which are connected or connecting
+        active = [0]
+
+        async def session():
+            smtp = None
+            try:
+                while pending:
+                    index, message = pending.pop()
+                    if not message.recipients():
+                        continue
+                    async with domain_limits[recipient_domain(message)]:
+                        if smtp is None:
+                            active[0] += 1
+                            try:
+                                smtp = await self._connect()
+                            except Exception as e:
+                                active[0] -= 1
+                                connect_errors.append(e)
+                                if active[0]:
+                                    # e.g. too many connections, leave the message to the other sessions
+                                    pending.append((index, message))
+                                else:
+                                    # the server cannot be reached, so fail the rest of the chunk
+                                    # instead of trying to connect for every message
+                                    results[index] = e
+                                    for pending_index, pending_message in pending:
+                                        results[pending_index] = e
+                                    del pending[:]
+                                return
+                        try:
+                            await self._send(smtp, message)
+                            results[index] = True
+                        except Exception as e:
+                            results[index] = e
+                            # the session may be broken, open a new one for the next message
+                            active[0] -= 1
+                            await self._close(smtp)
+                            smtp = None
+            finally:
+                if smtp is not None:
+                    active[0] -= 1
+                await self._close(smtp)
+
+        sessions = min(settings.CELERY_EMAIL_ASYNC_MAX_SESSIONS, len(email_messages))
+        await asyncio.gather(*(session() for _ in range(sessions)))
+        if connect_errors and True not in results:
+            raise BackendUnavailable("Cannot reach SMTP server %s:%s: %r" % (self.host, self.port, connect_errors[0]))
+        return results
+
+    async def _send(self, smtp, email_message):
+        encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email_message.from_email, encoding)
+        recipients = [sanitize_address(addr, encoding) for addr in email_message.recipients()]
+        message = email_message.message()
+        try:
+            await smtp.sendmail(from_email, recipients, message.as_bytes(linesep='\r\n'))
+        except aiosmtplib.SMTPRecipientsRefused as e:
+            # report refusals like smtplib does, so only these recipients are retried
+            raise smtplib.SMTPRecipientsRefused({
+                refused.recipient: (refused.code, refused.message) for refused in e.recipients})
+
+    @staticmethod
+    async def _close(smtp):
+        if smtp is None:
+            return
+        try:
+            await smtp.quit()
+        except Exception:
+            smtp.close()
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils.module_loading import import_string
+
+from djcelery_email.conf import resolved_setting
+
+KEY_RE = re.compile(r'[0-9a-f]{64}')
+
+
+def check_key(key):
+    """ Raises ValueError unless 'key' is a SHA-256 hex digest, so it can't point outside of the store. """
+    if not isinstance(key, str) or not KEY_RE.fullmatch(key):
+        raise ValueError("Invalid attachment store key %r." % (key,))
+    return key
+
+
+class BaseAttachmentStore(object):
+    """
+    Keeps attachment contents out of the task payload.
+
+    Contents are stored under their SHA-256 hex digest, so an attachment sent
+    to many recipients is only stored once.
+    """
+    def save(self, key, contents):
+        raise NotImplementedError
+
+    def load(self, key):
+        raise NotImplementedError
+
+    def store(self, contents):
+        key = hashlib.sha256(contents).hexdigest()
+        self.save(key, contents)
+        return key
+
+
+class FileSystemAttachmentStore(BaseAttachmentStore):
+    """
+    Stores attachments in a directory shared by the web processes and the workers.
+    """
+    def __init__(self, location):
+        self.location = location
+
+    def path(self, key):
+        return os.path.join(self.location, key[:2], key)
+
+    def save(self, key, contents):
+        path = self.path(key)
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # write to a temporary file first so workers never read partial contents
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
+
+    def load(self, key):
+        with open(self.path(check_key(key)), 'rb') as f:
+            return f.read()
+
+
+class StorageAttachmentStore(BaseAttachmentStore):
+    """
+    Stores attachments using a Django Storage, the default storage unless
+    'storage' (an instance or dotted path of a Storage class) is given.
+    """
+    def __init__(self, storage=None, prefix='djcelery_email'):
+        if storage is None:
+            from django.core.files.storage import default_storage
+            storage = default_storage
+        elif isinstance(storage, str):
+            storage = import_string(storage)()
+        self.storage = storage
+        self.prefix = prefix
+
+    def name(self, key):
+        return '/'.join([self.prefix, key[:2], key])
+
+    def save(self, key, contents):
+        name = self.name(key)
+        if not self.storage.exists(name):
+            self.storage.save(name, ContentFile(contents))
+
+    def load(self, key):
+        with self.storage.open(self.name(check_key(key)), 'rb') as f:
+            return f.read()
+
+
+@resolved_setting
+def get_attachment_store():
+    if not settings.CELERY_EMAIL_ATTACHMENT_STORE:
+        return None
+    store_class = import_string(settings.CELERY_EMAIL_ATTACHMENT_STORE)
+    return store_class(**settings.CELERY_EMAIL_ATTACHMENT_STORE_OPTIONS)
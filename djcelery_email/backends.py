@@ -1,18 +1,265 @@
+import json
+import time
+
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.core.mail.backends.base import BaseEmailBackend
+from django.db import transaction
+from django.utils import timezone
 
-from djcelery_email.tasks import send_emails
-from djcelery_email.utils import chunked, email_to_dict
+# Make sure our AppConf is loaded properly.
+import djcelery_email.conf  # noqa
+from djcelery_email.metrics import metrics_enabled, record, timer
+from djcelery_email.payload import TEXT_SERIALIZERS, encode_messages
+from djcelery_email.ratelimit import check_rate_limit_key
+from djcelery_email.results import SendResults
+from djcelery_email.utils import chunked, chunked_by_size, email_to_dict, payload_size, schedule_bucket
 
 
 class CeleryEmailBackend(BaseEmailBackend):
-    def __init__(self, fail_silently=False, **kwargs):
+    def __init__(self, fail_silently=False, lane=None, **kwargs):
         super(CeleryEmailBackend, self).__init__(fail_silently)
+        self.lane = lane
         self.init_kwargs = kwargs
 
     def send_messages(self, email_messages):
-        result_tasks = []
-        for chunk in chunked(email_messages, settings.CELERY_EMAIL_CHUNK_SIZE):
-            chunk_messages = [email_to_dict(msg) for msg in chunk]
-            result_tasks.append(send_emails.delay(chunk_messages, self.init_kwargs))
-        return result_tasks
+        if settings.CELERY_EMAIL_OUTBOX:
+            return self.save_to_outbox(email_messages)
+        results = SendResults()
+        email_messages = list(email_messages)
+        positions = list(range(len(email_messages)))
+        scheduled = [index for index, msg in enumerate(email_messages) if self.get_send_at(msg) is not None]
+        if scheduled:
+            # messages to send later wait in the outbox, so workers never hold them
+            self.save_to_outbox([email_messages[index] for index in scheduled])
+            results.scheduled_indexes = scheduled
+            positions = sorted(set(positions) - set(scheduled))
+            email_messages = [email_messages[index] for index in positions]
+        for indexes, result in self.enqueue_messages(email_messages):
+            results.append(result)
+            results.chunk_indexes.append([positions[index] for index in indexes])
+        return results
+
+    def save_to_outbox(self, email_messages):
+        """
+        Writes the messages to the OutboxMessage table in bulk and, with
+        CELERY_EMAIL_OUTBOX_DRAIN_ON_COMMIT, queues drain_outbox once the
+        current transaction commits. Returns the number of messages written.
+        """
+        from djcelery_email.models import OutboxMessage
+        from djcelery_email.tasks import drain_outbox
+
+        # the web process fails instead of queueing messages the workers would refuse
+        check_rate_limit_key()
+        backend_kwargs = json.dumps(self.init_kwargs, sort_keys=True)
+        # the outbox rows are JSON, so attachments are always base64 encoded
+        rows = [OutboxMessage(message=json.dumps(email_to_dict(msg, binary_attachments=False)),
+                              backend_kwargs=backend_kwargs, lane=self.get_lane(msg) or '',
+                              send_at=self.get_send_at(msg))
+                for msg in email_messages]
+        if not rows:
+            return 0
+        OutboxMessage.objects.bulk_create(rows, batch_size=settings.CELERY_EMAIL_OUTBOX_BATCH_SIZE)
+        record('messages_outboxed', len(rows))
+        # scheduled messages are left to the periodic drain
+        if settings.CELERY_EMAIL_OUTBOX_DRAIN_ON_COMMIT and any(row.send_at is None for row in rows):
+            transaction.on_commit(drain_outbox.delay)
+        return len(rows)
+
+    def stream_messages(self, email_messages):
+        """
+        Like send_messages, but for any iterable of messages, such as a
+        generator over a queryset. Chunks are published as the messages are
+        produced and no results are kept, so memory use does not grow with
+        the number of messages. Returns a summary dict instead of the results.
+
+        Messages with a 'send_at' time are written to the outbox in batches
+        of CELERY_EMAIL_OUTBOX_BATCH_SIZE and counted as 'scheduled'.
+        """
+        summary = {'messages': 0, 'chunks': 0, 'scheduled': 0, 'first_task_id': None, 'last_task_id': None}
+        scheduled = []
+
+        def send_now():
+            for message in email_messages:
+                if self.get_send_at(message) is None:
+                    yield message
+                    continue
+                scheduled.append(message)
+                if len(scheduled) == settings.CELERY_EMAIL_OUTBOX_BATCH_SIZE:
+                    summary['scheduled'] += self.save_to_outbox(scheduled)
+                    del scheduled[:]
+
+        for indexes, result in self.enqueue_messages(send_now()):
+            summary['messages'] += len(indexes)
+            summary['chunks'] += 1
+            if summary['first_task_id'] is None:
+                summary['first_task_id'] = result.id
+            summary['last_task_id'] = result.id
+        if scheduled:
+            summary['scheduled'] += self.save_to_outbox(scheduled)
+        return summary
+
+    def enqueue_messages(self, email_messages):
+        """
+        Publishes a task per chunk of 'email_messages' and yields the indexes
+        of the chunk's messages in 'email_messages' and the task's
+        AsyncResult. Each chunk is only built once the previous one has been
+        handed to the broker.
+
+        With CELERY_EMAIL_BULK_PUBLISH, all chunks are published with a
+        single producer taken from the Celery app's pool.
+        """
+        if not settings.CELERY_EMAIL_BULK_PUBLISH:
+            for item in self._publish_chunks(email_messages):
+                yield item
+            return
+
+        from djcelery_email.tasks import send_emails
+
+        with send_emails.app.producer_or_acquire() as producer:
+            for item in self._publish_chunks(email_messages, producer):
+                yield item
+
+    def _publish_chunks(self, email_messages, producer=None):
+        # the tasks module pulls in Celery, so it is only imported once there is mail to send
+        from djcelery_email.tasks import send_emails
+
+        check_rate_limit_key()
+        if settings.CELERY_EMAIL_BINARY_ATTACHMENTS and send_emails.serializer in TEXT_SERIALIZERS:
+            raise ImproperlyConfigured("CELERY_EMAIL_BINARY_ATTACHMENTS requires a binary safe serializer like "
+                                       "msgpack for the send_emails task, not %r." % send_emails.serializer)
+
+        # per message results are kept per task, so they cannot be tracked for coalesced messages
+        coalesce = settings.CELERY_EMAIL_COALESCE and not settings.CELERY_EMAIL_TRACK_RESULTS
+        if coalesce:
+            from djcelery_email.tasks import send_coalesced_emails
+            if send_coalesced_emails is None:
+                raise ImproperlyConfigured("CELERY_EMAIL_COALESCE requires the celery-batches package.")
+
+        chunks = self.lane_chunks(email_messages)
+        while True:
+            # the time spent producing a chunk is the time spent serializing its messages
+            start = time.perf_counter()
+            lane, indexes, chunk_messages = next(chunks, (None, None, None))
+            if chunk_messages is None:
+                break
+            payload = encode_messages(chunk_messages)
+            if metrics_enabled():
+                record('serialize', time.perf_counter() - start, 'timing')
+                record('chunk_bytes', payload_size(payload), 'size')
+                record('messages_enqueued', len(chunk_messages))
+            options = self.lane_options(lane)
+            task = send_coalesced_emails if coalesce and len(chunk_messages) == 1 else send_emails
+            with timer('enqueue'):
+                if producer is None and not options:
+                    result = task.delay(payload, self.init_kwargs)
+                else:
+                    result = task.apply_async((payload, self.init_kwargs), producer=producer, **options)
+            yield indexes, result
+
+    def get_lane(self, message):
+        """
+        Returns the name of the CELERY_EMAIL_PRIORITY_LANES lane for
+        'message': its 'lane' attribute, the backend's 'lane' argument or
+        CELERY_EMAIL_DEFAULT_LANE, in that order.
+        """
+        lanes = settings.CELERY_EMAIL_PRIORITY_LANES
+        if not lanes:
+            return None
+        lane = getattr(message, 'lane', None) or self.lane or settings.CELERY_EMAIL_DEFAULT_LANE
+        if lane is not None and lane not in lanes:
+            raise ImproperlyConfigured("Unknown priority lane %r, expected one of CELERY_EMAIL_PRIORITY_LANES: %s."
+                                       % (lane, ', '.join(sorted(lanes))))
+        return lane
+
+    def get_send_at(self, message):
+        """
+        Returns the CELERY_EMAIL_SCHEDULE_BUCKET_SECONDS time bucket of the
+        'send_at' datetime of 'message', or None if it is to be sent now.
+        Naive datetimes are in the current time zone.
+        """
+        send_at = getattr(message, 'send_at', None)
+        if send_at is None:
+            return None
+        if settings.USE_TZ and timezone.is_naive(send_at):
+            send_at = timezone.make_aware(send_at)
+        elif not settings.USE_TZ and timezone.is_aware(send_at):
+            send_at = timezone.make_naive(send_at)
+        if send_at <= timezone.now():
+            return None
+        return schedule_bucket(send_at, settings.CELERY_EMAIL_SCHEDULE_BUCKET_SECONDS)
+
+    def lane_options(self, lane):
+        """ Returns the apply_async options of 'lane', that is all of its settings but 'chunk_size'. """
+        if lane is None:
+            return {}
+        options = dict(settings.CELERY_EMAIL_PRIORITY_LANES[lane])
+        options.pop('chunk_size', None)
+        return options
+
+    def lane_chunks(self, email_messages):
+        """
+        Yields (lane, indexes, chunk) triples, chunking the messages of every
+        lane with that lane's 'chunk_size'. 'indexes' are the positions of
+        the chunk's messages in 'email_messages'. Messages are buffered per
+        lane until their chunk is full.
+        """
+        if not settings.CELERY_EMAIL_PRIORITY_LANES:
+            start = 0
+            for chunk in self.chunk_messages(email_messages):
+                yield None, list(range(start, start + len(chunk))), chunk
+                start += len(chunk)
+            return
+
+        buffers = {}
+        for index, msg in enumerate(email_messages):
+            lane = self.get_lane(msg)
+            buffer = buffers.setdefault(lane, [])
+            buffer.append((index, msg))
+            if len(buffer) >= self._max_chunk_messages(self._lane_chunk_size(lane)):
+                for item in self._chunk_buffer(lane, buffer):
+                    yield item
+                buffers[lane] = []
+        for lane, buffer in buffers.items():
+            for item in self._chunk_buffer(lane, buffer):
+                yield item
+
+    def _chunk_buffer(self, lane, buffer):
+        indexes = [index for index, msg in buffer]
+        start = 0
+        for chunk in self.chunk_messages([msg for index, msg in buffer], self._lane_chunk_size(lane)):
+            yield lane, indexes[start:start + len(chunk)], chunk
+            start += len(chunk)
+
+    def _lane_chunk_size(self, lane):
+        """ Returns the 'chunk_size' set for 'lane', or None to use the default chunk size. """
+        if lane is None:
+            return None
+        return settings.CELERY_EMAIL_PRIORITY_LANES[lane].get('chunk_size')
+
+    def _max_chunk_messages(self, chunk_size=None):
+        # an explicit chunk size, like a lane's, is never exceeded
+        if chunk_size:
+            return chunk_size
+        if settings.CELERY_EMAIL_CHUNK_MAX_BYTES:
+            return settings.CELERY_EMAIL_CHUNK_MAX_MESSAGES or settings.CELERY_EMAIL_CHUNK_SIZE
+        return settings.CELERY_EMAIL_CHUNK_SIZE
+
+    def chunk_messages(self, email_messages, chunk_size=None):
+        """
+        Yields the messages as lists of dicts, one list per task, of
+        'chunk_size' (defaults to CELERY_EMAIL_CHUNK_SIZE) messages. With
+        CELERY_EMAIL_CHUNK_MAX_BYTES set, chunks are cut by payload size and
+        may hold up to 'chunk_size' or, without one, up to
+        CELERY_EMAIL_CHUNK_MAX_MESSAGES messages.
+        """
+        chunksize = self._max_chunk_messages(chunk_size)
+        max_bytes = settings.CELERY_EMAIL_CHUNK_MAX_BYTES
+        if not max_bytes:
+            for chunk in chunked(email_messages, chunksize):
+                yield [email_to_dict(msg) for msg in chunk]
+            return
+
+        message_dicts = (email_to_dict(msg) for msg in email_messages)
+        for chunk in chunked_by_size(message_dicts, chunksize, max_bytes):
+            yield chunk
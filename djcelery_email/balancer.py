@@ -0,0 +1,97 @@
+import contextlib
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from djcelery_email.circuit import get_circuit_breaker
+from djcelery_email.conf import resolved_setting
+from djcelery_email.pool import ConnectionPool
+
+SELECTIONS = ('round_robin', 'least_loaded')
+
+
+class Relay(object):
+    """ One of the CELERY_EMAIL_BACKENDS: a backend, its kwargs and its share of the messages. """
+    def __init__(self, backend, kwargs=None, weight=1):
+        if weight <= 0:
+            raise ImproperlyConfigured("The weight of CELERY_EMAIL_BACKENDS entry %r must be positive." % backend)
+        self.backend = backend
+        self.kwargs = kwargs or {}
+        self.weight = weight
+        # the state kept by the balancer, in this process
+        self.current_weight = 0
+        self.in_flight = 0
+        self.handled = 0
+
+    def backend_kwargs(self, backend_kwargs):
+        """ Returns the kwargs of this relay, updated with the ones the messages were queued with. """
+        return dict(self.kwargs, **backend_kwargs)
+
+    def is_healthy(self, backend_kwargs):
+        """ Returns False while the circuit breaker of this relay is open. """
+        if not settings.CELERY_EMAIL_CIRCUIT_BREAKER:
+            return True
+        key = ConnectionPool.make_key(self.backend, self.backend_kwargs(backend_kwargs))
+        return not get_circuit_breaker(key).retry_after()
+
+
+class BackendBalancer(object):
+    """
+    Spreads chunks over the CELERY_EMAIL_BACKENDS of this worker process.
+
+    With 'round_robin', relays take turns in proportion to their weights
+    (smooth weighted round robin). With 'least_loaded', the relay with the
+    fewest messages being sent per weight is picked, which falls back to
+    the fewest messages handled so far when a process sends one chunk at a
+    time. Relays whose circuit breaker is open are tried last.
+    """
+    def __init__(self, relays, selection='round_robin'):
+        if selection not in SELECTIONS:
+            raise ImproperlyConfigured("Unknown CELERY_EMAIL_BACKEND_SELECTION %r, expected one of: %s."
+                                       % (selection, ', '.join(SELECTIONS)))
+        self._lock = threading.Lock()
+        self.relays = relays
+        self.selection = selection
+
+    def candidates(self, backend_kwargs):
+        """ Returns the relays in the order they should be tried for the next chunk. """
+        with self._lock:
+            if self.selection == 'round_robin':
+                total = sum(relay.weight for relay in self.relays)
+                for relay in self.relays:
+                    relay.current_weight += relay.weight
+                first = max(self.relays, key=lambda relay: relay.current_weight)
+                first.current_weight -= total
+                start = self.relays.index(first)
+                ordered = self.relays[start:] + self.relays[:start]
+            else:
+                ordered = sorted(self.relays, key=lambda relay: (float(relay.in_flight) / relay.weight,
+                                                                 float(relay.handled) / relay.weight))
+        # sorted() is stable, so the healthy relays keep their order
+        return sorted(ordered, key=lambda relay: not relay.is_healthy(backend_kwargs))
+
+    @contextlib.contextmanager
+    def sending(self, relay, count):
+        """ Counts 'count' messages as being sent by 'relay' while the block runs. """
+        with self._lock:
+            relay.in_flight += count
+        try:
+            yield
+        finally:
+            with self._lock:
+                relay.in_flight -= count
+                relay.handled += count
+
+
+@resolved_setting
+def get_balancer():
+    """ Returns the BackendBalancer of the CELERY_EMAIL_BACKENDS, or None if there are none. """
+    if not settings.CELERY_EMAIL_BACKENDS:
+        return None
+    relays = []
+    for entry in settings.CELERY_EMAIL_BACKENDS:
+        if isinstance(entry, str):
+            entry = {'backend': entry}
+        relays.append(Relay(entry['backend'], entry.get('kwargs'), entry.get('weight', 1)))
+    return BackendBalancer(relays, settings.CELERY_EMAIL_BACKEND_SELECTION)
@@ -0,0 +1,97 @@
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+
+
+class BackendUnavailable(Exception):
+    """
+    Raised instead of sending a chunk when the backend cannot be reached or
+    its circuit breaker is open. 'retry_after' is the number of seconds until
+    the breaker lets a probe through.
+    """
+    def __init__(self, message, retry_after=0):
+        super(BackendUnavailable, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def is_message_error(exc):
+    """
+    Returns True if 'exc' is about a single message, like a refused
+    recipient or a permanently rejected message, which says nothing about
+    the health of the backend.
+    """
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(exc, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+        return exc.smtp_code >= 500
+    return False
+
+
+class CircuitBreaker(object):
+    """
+    Counts consecutive failed chunks for a backend in this worker process.
+
+    After CELERY_EMAIL_CIRCUIT_BREAKER_THRESHOLD failures the breaker opens
+    and chunks are deferred without contacting the backend. Once
+    CELERY_EMAIL_CIRCUIT_BREAKER_RESET_TIMEOUT seconds have passed, chunks are
+    let through again as probes, and the breaker closes after
+    CELERY_EMAIL_CIRCUIT_BREAKER_PROBE_SUCCESSES successful ones. A failed
+    probe opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probe_successes = 0
+        self.opened_at = None
+
+    def retry_after(self):
+        if self.state != self.OPEN:
+            return 0
+        elapsed = time.monotonic() - self.opened_at
+        return max(settings.CELERY_EMAIL_CIRCUIT_BREAKER_RESET_TIMEOUT - elapsed, 0)
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN and not self.retry_after():
+                self.state = self.HALF_OPEN
+                self.probe_successes = 0
+            return self.state != self.OPEN
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state == self.HALF_OPEN:
+                self.probe_successes += 1
+                if self.probe_successes >= settings.CELERY_EMAIL_CIRCUIT_BREAKER_PROBE_SUCCESSES:
+                    self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= settings.CELERY_EMAIL_CIRCUIT_BREAKER_THRESHOLD):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(key):
+    with _breakers_lock:
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker()
+        return _breakers[key]
+
+
+def reset_circuit_breakers():
+    with _breakers_lock:
+        _breakers.clear()
@@ -1,3 +1,8 @@
+import functools
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
 from appconf import AppConf
 
 
@@ -7,5 +12,74 @@ class DjangoCeleryEmailAppConf(AppConf):
 
     TASK_CONFIG = {}
     BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+    BACKENDS = []
+    BACKEND_SELECTION = 'round_robin'
     CHUNK_SIZE = 10
+    CHUNK_MAX_BYTES = None
+    CHUNK_MAX_MESSAGES = None
+    PRIORITY_LANES = {}
+    DEFAULT_LANE = None
     MESSAGE_EXTRA_ATTRIBUTES = None
+    BATCH_SEND = False
+    BULK_PUBLISH = False
+    COALESCE = False
+    COALESCE_FLUSH_EVERY = 100  # tasks
+    COALESCE_FLUSH_INTERVAL = 1  # seconds
+    PRECOMPILE_MIME = False
+    PRECOMPILE_MIME_CACHE_SIZE = 16
+    IDEMPOTENCY = False
+    IDEMPOTENCY_CACHE = 'default'
+    IDEMPOTENCY_TIMEOUT = 24 * 60 * 60  # seconds
+    IDEMPOTENCY_CLAIM_TIMEOUT = 5 * 60  # seconds
+    OUTBOX = False
+    OUTBOX_BATCH_SIZE = 500
+    OUTBOX_DRAIN_ON_COMMIT = True
+    SCHEDULE_BUCKET_SECONDS = 60
+    RETRY_DELAY = None  # seconds, defaults to the task's default_retry_delay
+    RETRY_BACKOFF = False
+    RETRY_BACKOFF_MAX = 600  # seconds
+    RETRY_JITTER = False
+    RATE_LIMITS = {}
+    RATE_LIMIT_KEY = 'domain'
+    RATE_LIMIT_CACHE = None
+    METRICS_HOOK = None
+    TRACK_RESULTS = False
+    CIRCUIT_BREAKER = False
+    CIRCUIT_BREAKER_THRESHOLD = 5  # consecutive failed chunks
+    CIRCUIT_BREAKER_RESET_TIMEOUT = 30  # seconds
+    CIRCUIT_BREAKER_PROBE_SUCCESSES = 1
+    ENGINE = 'sync'
+    ASYNC_MAX_SESSIONS = 10
+    ASYNC_MAX_SESSIONS_PER_DOMAIN = 2
+    PAYLOAD_CODEC = None
+    BINARY_ATTACHMENTS = False
+    ATTACHMENT_STORE = None
+    ATTACHMENT_STORE_OPTIONS = {}
+    ATTACHMENT_STORE_THRESHOLD = 64 * 1024  # bytes
+    CONNECTION_POOL = False
+    CONNECTION_POOL_MAX_IDLE = 60  # seconds
+    CONNECTION_POOL_MAX_MESSAGES = 100
+
+
+_resolved = {}
+
+
+def resolved_setting(func):
+    """
+    Caches what 'func' resolves from the CELERY_EMAIL_ settings, like an
+    imported class, until one of those settings changes.
+    """
+    @functools.wraps(func)
+    def wrapper():
+        try:
+            return _resolved[func]
+        except KeyError:
+            value = _resolved[func] = func()
+            return value
+    return wrapper
+
+
+@receiver(setting_changed)
+def clear_resolved_settings(setting, **kwargs):
+    if setting.startswith('CELERY_EMAIL_'):
+        _resolved.clear()
@@ -0,0 +1,76 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+
+CLAIMED = 'claimed'
+SENT = 'sent'
+
+
+def _cache_key(key):
+    return 'djcelery_email:sent:%s' % key
+
+
+def templated_idempotency_key(task_id, recipient_list, context):
+    """
+    Returns a key for a message rendered by send_templated_emails, which is
+    the same whenever the task with 'task_id' is delivered again.
+    """
+    data = json.dumps([task_id, recipient_list, context], sort_keys=True, default=str)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+class IdempotencyGuard(object):
+    """
+    Keeps track of the 'idempotency_key' of message dicts in the Django cache
+    named by CELERY_EMAIL_IDEMPOTENCY_CACHE, shared by all workers.
+
+    A message is claimed with an atomic cache.add() before it is sent, so
+    only one worker sends it even if its chunk is delivered twice at once.
+    Sent messages are remembered for CELERY_EMAIL_IDEMPOTENCY_TIMEOUT
+    seconds. Claims of messages which failed are released so their retry
+    can claim them again, and claims of a worker which died expire after
+    CELERY_EMAIL_IDEMPOTENCY_CLAIM_TIMEOUT seconds.
+    """
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def claim(self, messages):
+        """ Returns the indexes of the messages which were claimed and may be sent. """
+        keys = [message.get('idempotency_key') for message in messages]
+        known = self.cache.get_many([_cache_key(key) for key in keys if key])
+        claimed = []
+        timeout = settings.CELERY_EMAIL_IDEMPOTENCY_CLAIM_TIMEOUT
+        for index, key in enumerate(keys):
+            if key:
+                if _cache_key(key) in known:
+                    continue
+                if not self.cache.add(_cache_key(key), CLAIMED, timeout=timeout):
+                    continue
+            claimed.append(index)
+        return claimed
+
+    def finish(self, messages, failed_indexes):
+        """ Marks the claimed 'messages' as sent, except the ones at 'failed_indexes'. """
+        failed_indexes = set(failed_indexes)
+        sent = {}
+        released = []
+        for index, message in enumerate(messages):
+            key = message.get('idempotency_key')
+            if not key:
+                continue
+            if index in failed_indexes:
+                released.append(_cache_key(key))
+            else:
+                sent[_cache_key(key)] = SENT
+        if sent:
+            self.cache.set_many(sent, timeout=settings.CELERY_EMAIL_IDEMPOTENCY_TIMEOUT)
+        if released:
+            self.cache.delete_many(released)
+
+
+def get_idempotency_guard():
+    if not settings.CELERY_EMAIL_IDEMPOTENCY:
+        return None
+    return IdempotencyGuard(settings.CELERY_EMAIL_IDEMPOTENCY_CACHE)
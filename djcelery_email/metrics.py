@@ -0,0 +1,52 @@
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from djcelery_email.conf import resolved_setting
+from djcelery_email.signals import metric_recorded
+
+
+@resolved_setting
+def get_metrics_hook():
+    path = settings.CELERY_EMAIL_METRICS_HOOK
+    if not path:
+        return None
+    return import_string(path)
+
+
+def metrics_enabled():
+    return bool(settings.CELERY_EMAIL_METRICS_HOOK) or metric_recorded.has_listeners()
+
+
+def record(name, value, kind='counter', **tags):
+    """
+    Passes a metric to the CELERY_EMAIL_METRICS_HOOK callable and to the
+    receivers of the metric_recorded signal.
+    """
+    hook = get_metrics_hook()
+    if hook is not None:
+        hook(name, value, kind, tags)
+    metric_recorded.send(sender=None, name=name, value=value, kind=kind, tags=tags)
+
+
+class timer(object):
+    """
+    Records the time spent in a with block as a 'timing' metric, if any
+    metrics consumer is configured.
+    """
+    __slots__ = ('name', 'tags', 'start')
+
+    def __init__(self, name, **tags):
+        self.name = name
+        self.tags = tags
+        self.start = None
+
+    def __enter__(self):
+        if metrics_enabled():
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is not None:
+            record(self.name, time.perf_counter() - self.start, 'timing', **self.tags)
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djcelery_email', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='send_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,144 @@
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+from email.generator import BytesGenerator
+from email.mime.base import MIMEBase
+from io import BytesIO
+
+from django.conf import settings
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.core.mail.message import SafeMIMEMultipart
+
+# the line separator of the SMTP backend, whose flattened parts are cached
+SMTP_LINESEP = '\r\n'
+
+
+class MIMECache(object):
+    """
+    Keeps the last CELERY_EMAIL_PRECOMPILE_MIME_CACHE_SIZE MIME content trees
+    built in this process, keyed by content_key().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trees = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            tree = self._trees.get(key)
+            if tree is not None:
+                self._trees.move_to_end(key)
+            return tree
+
+    def set(self, key, tree):
+        with self._lock:
+            self._trees[key] = tree
+            self._trees.move_to_end(key)
+            while len(self._trees) > settings.CELERY_EMAIL_PRECOMPILE_MIME_CACHE_SIZE:
+                self._trees.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+
+
+mime_cache = MIMECache()
+
+
+def content_key(message):
+    """
+    Returns a hash of everything which goes into the MIME content of
+    'message', i.e. all but its envelope and headers, or None if it has
+    attachments which cannot be hashed.
+    """
+    digest = hashlib.sha1()
+
+    def update(value):
+        if value is None:
+            value = b''
+        elif isinstance(value, str):
+            value = value.encode('utf-8', 'surrogatepass')
+        digest.update(b'%d:' % len(value))
+        digest.update(value)
+
+    for value in (message.body, message.content_subtype, message.mixed_subtype,
+                  message.encoding or settings.DEFAULT_CHARSET):
+        update(value)
+    for content, mimetype in getattr(message, 'alternatives', None) or []:
+        update(content)
+        update(mimetype)
+    for attachment in message.attachments:
+        if isinstance(attachment, MIMEBase):
+            return None
+        for value in attachment:
+            update(value)
+    return digest.hexdigest()
+
+
+class PrecompiledGenerator(BytesGenerator):
+    """ A BytesGenerator which writes the cached bytes of precompiled parts as they are. """
+    def flatten(self, msg, unixfrom=False, linesep=None):
+        flattened = getattr(msg, 'flattened', None)
+        if flattened is not None and not unixfrom and linesep == SMTP_LINESEP:
+            self.write(flattened)
+            return
+        super(PrecompiledGenerator, self).flatten(msg, unixfrom=unixfrom, linesep=linesep)
+
+    def write(self, s):
+        if isinstance(s, bytes):
+            self._fp.write(s)
+        else:
+            super(PrecompiledGenerator, self).write(s)
+
+
+class PrecompiledMIMEMultipart(SafeMIMEMultipart):
+    """ The outer part of a precompiled message, flattened with a PrecompiledGenerator. """
+    def as_bytes(self, unixfrom=False, linesep='\n'):
+        fp = BytesIO()
+        g = PrecompiledGenerator(fp, mangle_from_=False)
+        g.flatten(self, unixfrom=unixfrom, linesep=linesep)
+        return fp.getvalue()
+
+
+def precompile(tree):
+    """
+    Flattens the leaf parts of MIME tree 'tree' once, so copies of it can
+    be flattened without encoding their contents again.
+    """
+    for part in tree.walk():
+        if not part.is_multipart():
+            fp = BytesIO()
+            BytesGenerator(fp, mangle_from_=False).flatten(part, linesep=SMTP_LINESEP)
+            part.flattened = fp.getvalue()
+    if isinstance(tree, SafeMIMEMultipart):
+        # its copies get the headers of each message and are flattened by the SMTP backend
+        tree.__class__ = PrecompiledMIMEMultipart
+    return tree
+
+
+class PrecompiledMIMEMixin(object):
+    """
+    Reuses the MIME content (body, alternatives and attachments) of messages
+    which only differ in their headers, instead of encoding it for every
+    message. Headers are set on a copy of the cached MIME tree.
+    """
+    def _create_message(self, msg):
+        if not self.attachments and not getattr(self, 'alternatives', None):
+            return super(PrecompiledMIMEMixin, self)._create_message(msg)
+        key = content_key(self)
+        if key is None:
+            return super(PrecompiledMIMEMixin, self)._create_message(msg)
+
+        tree = mime_cache.get(key)
+        if tree is None:
+            tree = precompile(super(PrecompiledMIMEMixin, self)._create_message(msg))
+            mime_cache.set(key, tree)
+        return copy.deepcopy(tree)
+
+
+class PrecompiledEmailMessage(PrecompiledMIMEMixin, EmailMessage):
+    pass
+
+
+class PrecompiledEmailMultiAlternatives(PrecompiledMIMEMixin, EmailMultiAlternatives):
+    pass
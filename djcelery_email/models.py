@@ -0,0 +1,23 @@
+from django.db import models
+
+
+class OutboxMessage(models.Model):
+    """
+    A message written by CeleryEmailBackend with CELERY_EMAIL_OUTBOX, waiting
+    for the drain_outbox task to publish it. 'message' and 'backend_kwargs'
+    hold the JSON encoded message dict and backend keyword arguments, 'lane'
+    its CELERY_EMAIL_PRIORITY_LANES lane, if any. Messages with a 'send_at'
+    time are not published before it.
+    """
+    id = models.BigAutoField(primary_key=True)
+    message = models.TextField()
+    backend_kwargs = models.TextField(default='{}')
+    lane = models.CharField(max_length=100, blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    send_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        ordering = ('pk',)
+
+    def __str__(self):
+        return 'Outbox message %s' % self.pk
@@ -0,0 +1,130 @@
+import base64
+import json
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Marks a chunk of messages encoded by encode_messages. Anything else passed to
+# the send_emails task is treated as plain message dicts.
+PAYLOAD_KEY = 'djcelery_email_payload'
+PAYLOAD_VERSION = 1
+# Payloads with CELERY_EMAIL_BINARY_ATTACHMENTS, which carry the compressed
+# data and the attachment contents as bytes instead of base64.
+BINARY_PAYLOAD_VERSION = 2
+
+# Serializers which cannot carry bytes.
+TEXT_SERIALIZERS = ('json', 'yaml')
+
+# Fields which are commonly identical across the messages of a chunk, like
+# with send_mass_mail. Each distinct value is only stored once per chunk.
+SHARED_FIELDS = ('body', 'alternatives', 'headers', 'from_email')
+
+
+def _compress(codec, data):
+    if codec == 'zlib':
+        return zlib.compress(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImproperlyConfigured("The 'zstd' payload codec requires the zstandard package.")
+        return zstandard.ZstdCompressor().compress(data)
+    raise ImproperlyConfigured("Unknown CELERY_EMAIL_PAYLOAD_CODEC %r." % codec)
+
+
+def _decompress(codec, data):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImproperlyConfigured("The 'zstd' payload codec requires the zstandard package.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown payload codec %r." % codec)
+
+
+def is_encoded(messages):
+    return isinstance(messages, dict) and PAYLOAD_KEY in messages
+
+
+def _extract_blobs(message, blobs):
+    """
+    Moves the binary attachment contents of 'message' to 'blobs', leaving
+    their index behind. They are already compressed more often than not.
+    """
+    attachments = []
+    for filename, contents, mimetype in message['attachments']:
+        if isinstance(contents, (bytes, bytearray, memoryview)):
+            blobs.append(bytes(contents))
+            contents = {'blob': len(blobs) - 1}
+        attachments.append((filename, contents, mimetype))
+    message['attachments'] = attachments
+
+
+def encode_messages(messages):
+    """
+    Encodes a chunk of message dicts with CELERY_EMAIL_PAYLOAD_CODEC, or
+    returns them unchanged if no codec is configured.
+    """
+    codec = settings.CELERY_EMAIL_PAYLOAD_CODEC
+    if not codec:
+        return messages
+
+    binary = settings.CELERY_EMAIL_BINARY_ATTACHMENTS
+    blobs = []
+    shared = {field: [] for field in SHARED_FIELDS}
+    seen = {field: {} for field in SHARED_FIELDS}
+    compact = []
+    for message in messages:
+        message = dict(message)
+        if binary and message.get('attachments'):
+            _extract_blobs(message, blobs)
+        for field in SHARED_FIELDS:
+            if field not in message:
+                continue
+            value = message[field]
+            key = json.dumps(value, sort_keys=True)
+            if key not in seen[field]:
+                seen[field][key] = len(shared[field])
+                shared[field].append(value)
+            message[field] = seen[field][key]
+        compact.append(message)
+
+    data = _compress(codec, json.dumps({'shared': shared, 'messages': compact}, separators=(',', ':')).encode('utf-8'))
+    if binary:
+        return {PAYLOAD_KEY: BINARY_PAYLOAD_VERSION, 'codec': codec, 'data': data, 'blobs': blobs}
+    return {
+        PAYLOAD_KEY: PAYLOAD_VERSION,
+        'codec': codec,
+        'data': base64.b64encode(data).decode('ascii'),
+    }
+
+
+def decode_messages(payload):
+    """ Turns the output of encode_messages back into a list of message dicts. """
+    version = payload[PAYLOAD_KEY]
+    if version == PAYLOAD_VERSION:
+        data = base64.b64decode(payload['data'].encode('ascii'))
+    elif version == BINARY_PAYLOAD_VERSION:
+        data = bytes(payload['data'])
+    else:
+        raise ValueError("Unsupported payload version %r." % version)
+
+    decoded = json.loads(_decompress(payload['codec'], data).decode('utf-8'))
+    shared = decoded['shared']
+    messages = decoded['messages']
+    blobs = payload.get('blobs') or []
+    for message in messages:
+        for field in SHARED_FIELDS:
+            if field in message:
+                message[field] = shared[field][message[field]]
+        if blobs and message.get('attachments'):
+            message['attachments'] = [
+                (filename, blobs[contents['blob']] if isinstance(contents, dict) and 'blob' in contents else contents,
+                 mimetype)
+                for filename, contents, mimetype in message['attachments']
+            ]
+    return messages
@@ -0,0 +1,119 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+from celery.signals import worker_process_shutdown
+
+from djcelery_email.metrics import record
+
+
+def connection_is_alive(connection):
+    """
+    Checks if an opened backend connection can still be used.
+
+    Backends exposing an smtplib connection (like Django's SMTP backend) are
+    asked for a NOOP, anything else is assumed to be alive.
+    """
+    smtp = getattr(connection, 'connection', None)
+    if smtp is None or not hasattr(smtp, 'noop'):
+        return True
+    try:
+        return smtp.noop()[0] == 250
+    except Exception:
+        return False
+
+
+class PooledConnection(object):
+    def __init__(self, key, connection):
+        self.key = key
+        self.connection = connection
+        self.message_count = 0
+        self.last_used = time.monotonic()
+
+
+class ConnectionPool(object):
+    """
+    A per process pool of opened email backend connections.
+
+    Connections are keyed by backend and backend kwargs and are handed out to
+    one task at a time. While the pool is disabled (CELERY_EMAIL_CONNECTION_POOL)
+    every acquired connection is a new one and is closed on release.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._borrowed = {}
+
+    @staticmethod
+    def make_key(backend, kwargs):
+        return backend, tuple(sorted((name, repr(value)) for name, value in kwargs.items()))
+
+    def acquire(self, backend, **kwargs):
+        key = self.make_key(backend, kwargs)
+        stale = []
+        entry = None
+        if settings.CELERY_EMAIL_CONNECTION_POOL:
+            now = time.monotonic()
+            with self._lock:
+                idle = self._idle.get(key, [])
+                while idle:
+                    candidate = idle.pop()
+                    if now - candidate.last_used > settings.CELERY_EMAIL_CONNECTION_POOL_MAX_IDLE:
+                        stale.append(candidate)
+                    else:
+                        entry = candidate
+                        break
+
+        for candidate in stale:
+            self._close(candidate)
+        if entry is not None and not connection_is_alive(entry.connection):
+            self._close(entry)
+            entry = None
+        record('connection_acquired', 1, reused=entry is not None)
+        if entry is None:
+            entry = PooledConnection(key, get_connection(backend=backend, **kwargs))
+
+        with self._lock:
+            self._borrowed[id(entry.connection)] = entry
+        return entry.connection
+
+    def release(self, connection, message_count=0, discard=False):
+        with self._lock:
+            entry = self._borrowed.pop(id(connection), None)
+        if entry is None:
+            connection.close()
+            return
+
+        entry.message_count += message_count
+        entry.last_used = time.monotonic()
+        if (discard or not settings.CELERY_EMAIL_CONNECTION_POOL or
+                entry.message_count >= settings.CELERY_EMAIL_CONNECTION_POOL_MAX_MESSAGES):
+            self._close(entry)
+            return
+
+        with self._lock:
+            self._idle.setdefault(entry.key, []).append(entry)
+
+    def close_all(self):
+        with self._lock:
+            entries = [entry for idle in self._idle.values() for entry in idle]
+            self._idle = {}
+        for entry in entries:
+            self._close(entry)
+
+    @staticmethod
+    def _close(entry):
+        try:
+            entry.connection.close()
+        except Exception:
+            pass
+
+
+connection_pool = ConnectionPool()
+
+
+@worker_process_shutdown.connect
+def close_pooled_connections(**kwargs):
+    connection_pool.close_all()
@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parseaddr
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+from kombu.utils.limits import TokenBucket
+
+RATE_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60}
+
+
+def parse_rate(rate):
+    """
+    Parses a rate like Celery's rate_limit into (messages, seconds).
+
+    >>> parse_rate('100/m')
+    (100, 60)
+    """
+    count, _, unit = rate.partition('/')
+    return int(count), RATE_UNITS[unit or 's']
+
+
+def check_rate_limit_key():
+    """ Raises ImproperlyConfigured if CELERY_EMAIL_RATE_LIMIT_KEY cannot be used with the other settings. """
+    if settings.CELERY_EMAIL_RATE_LIMIT_KEY == 'backend' and settings.CELERY_EMAIL_BACKENDS:
+        # the backend is only picked when the messages are sent, after they were rate limited
+        raise ImproperlyConfigured("CELERY_EMAIL_RATE_LIMIT_KEY = 'backend' cannot be used with "
+                                   "CELERY_EMAIL_BACKENDS, limit the messages per domain instead.")
+
+
+def rate_limit_keys(message):
+    """ Returns the keys of the CELERY_EMAIL_RATE_LIMITS that apply to message dict 'message'. """
+    if settings.CELERY_EMAIL_RATE_LIMIT_KEY == 'backend':
+        check_rate_limit_key()
+        return [settings.CELERY_EMAIL_BACKEND]
+    domains = set()
+    for field in ('to', 'cc', 'bcc'):
+        for addr in message.get(field) or []:
+            domains.add(parseaddr(addr)[1].rpartition('@')[2].lower())
+    return sorted(domains)
+
+
+class LocalRateLimiter(object):
+    """ Token buckets kept in this process, holding up to one full rate period worth of messages. """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def _bucket(self, key, rate):
+        bucket = self._buckets.get((key, rate))
+        if bucket is None:
+            count, seconds = parse_rate(rate)
+            bucket = self._buckets[(key, rate)] = TokenBucket(float(count) / seconds, capacity=count)
+        return bucket
+
+    def acquire(self, limits):
+        """
+        Takes a token for every (key, rate) pair in 'limits' if each of them
+        has one. Returns the number of seconds to wait for a token per pair,
+        which are all 0 if the tokens were taken.
+        """
+        with self._lock:
+            buckets = [self._bucket(key, rate) for key, rate in limits]
+            waits = [bucket.expected_time(1) for bucket in buckets]
+            if not any(waits):
+                for bucket in buckets:
+                    bucket.can_consume(1)
+            return waits
+
+
+class CacheRateLimiter(object):
+    """
+    Counts messages in fixed time windows in a Django cache shared by all
+    workers. Relies on atomic cache.incr, as provided by Redis and Memcached.
+    """
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def acquire(self, limits):
+        """ Like LocalRateLimiter.acquire, counting the message in every window if each has room for it. """
+        now = time.time()
+        windows = []
+        waits = []
+        for key, rate in limits:
+            count, seconds = parse_rate(rate)
+            window = int(now // seconds)
+            cache_key = 'djcelery_email:ratelimit:%s:%s:%d' % (key, rate, window)
+            windows.append((cache_key, count, seconds))
+            full = self.cache.get(cache_key, 0) >= count
+            waits.append((window + 1) * seconds - now if full else 0)
+        if any(waits):
+            return waits
+
+        counted = []
+        for index, (cache_key, count, seconds) in enumerate(windows):
+            self.cache.add(cache_key, 0, timeout=seconds * 2)
+            try:
+                sent = self.cache.incr(cache_key)
+            except ValueError:
+                # expired between add() and incr()
+                self.cache.add(cache_key, 1, timeout=seconds * 2)
+                sent = 1
+            counted.append(cache_key)
+            if sent > count:
+                # another worker filled the window in the meantime, so give the message back
+                for counted_key in counted:
+                    try:
+                        self.cache.decr(counted_key)
+                    except ValueError:
+                        pass
+                waits[index] = (int(now // seconds) + 1) * seconds - now
+                return waits
+        return waits
+
+
+local_rate_limiter = LocalRateLimiter()
+
+
+def get_rate_limiter():
+    if settings.CELERY_EMAIL_RATE_LIMIT_CACHE:
+        return CacheRateLimiter(settings.CELERY_EMAIL_RATE_LIMIT_CACHE)
+    return local_rate_limiter
+
+
+def rate_limit(messages):
+    """
+    Splits message dicts into the indexes of messages which may be sent now
+    and groups of messages which have to be deferred. Returns the allowed
+    indexes and a list of (countdown, indexes) pairs for the deferred ones.
+
+    Deferred messages take no tokens and are spread out instead: the nth
+    message deferred for a key is due once that key has a token again plus
+    n / rate seconds. They are grouped per shortest rate period, and each
+    group is deferred until its last message is due, by when the buckets
+    have refilled for all of them.
+    """
+    limits = settings.CELERY_EMAIL_RATE_LIMITS
+    if not limits:
+        return list(range(len(messages))), []
+
+    limiter = get_rate_limiter()
+    allowed = []
+    due = []
+    queued = {}
+    for index, message in enumerate(messages):
+        pairs = [(key, limits.get(key, limits.get('*'))) for key in rate_limit_keys(message)]
+        pairs = [(key, rate) for key, rate in pairs if rate]
+        waits = limiter.acquire(pairs) if pairs else []
+        if not any(waits):
+            allowed.append(index)
+            continue
+
+        countdown = 0
+        for (key, rate), wait in zip(pairs, waits):
+            count, seconds = parse_rate(rate)
+            position = queued.get((key, rate), 0)
+            queued[(key, rate)] = position + 1
+            countdown = max(countdown, wait + position * float(seconds) / count)
+        due.append((countdown, index))
+
+    period = min(parse_rate(rate)[1] for rate in limits.values() if rate)
+    groups = OrderedDict()
+    due.sort()
+    for countdown, index in due:
+        # countdowns measured a little later come out a little shorter, so allow for some slack
+        window = int((countdown - due[0][0]) / period + 1e-3)
+        groups.setdefault(window, []).append((countdown, index))
+    return allowed, [(group[-1][0], sorted(index for countdown, index in group)) for group in groups.values()]
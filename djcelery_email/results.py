@@ -0,0 +1,113 @@
+import smtplib
+
+from django.conf import settings
+
+SENT = 'sent'
+FAILED = 'failed'
+RETRIED = 'retried'
+DEFERRED = 'deferred'
+SKIPPED = 'skipped'
+PENDING = 'pending'
+SCHEDULED = 'scheduled'
+
+
+def smtp_code(exc):
+    """ Returns the SMTP response code of exception 'exc', if it has one. """
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        for code, response in exc.recipients.values():
+            return code
+    return getattr(exc, 'smtp_code', None)
+
+
+class ResultTracker(object):
+    """
+    Collects a [position, status, detail] result per message of a
+    send_emails task with CELERY_EMAIL_TRACK_RESULTS, where 'position' is
+    the index of the message in the chunk as it was first queued. 'detail'
+    is the SMTP response code of failed messages and the task id of
+    deferred ones.
+
+    Tasks which continue the work of a chunk, i.e. its retry and the task
+    its deferred messages are queued in, are passed the positions of their
+    messages. A retry keeps the task id of the chunk and overwrites its
+    result, so it is also passed the results collected so far.
+    """
+    def __init__(self, count, tracking=None):
+        self.enabled = settings.CELERY_EMAIL_TRACK_RESULTS
+        tracking = tracking or {}
+        self.positions = tracking.get('positions') or list(range(count))
+        self.results = list(tracking.get('results') or [])
+
+    def keep(self, indexes):
+        """ Narrows the tracked messages down to the ones at 'indexes'. """
+        self.positions = [self.positions[index] for index in indexes]
+
+    def mark(self, indexes, status, detail=None):
+        if self.enabled:
+            self.results.extend([self.positions[index], status, detail] for index in indexes)
+
+    def follow_up(self, indexes, retry=False):
+        """ Returns the task kwargs which let the task continuing with the messages at 'indexes' track them. """
+        if not self.enabled:
+            return {}
+        tracking = {'positions': [self.positions[index] for index in indexes]}
+        if retry:
+            tracking['results'] = list(self.results)
+        return {'tracking': tracking}
+
+    def result(self, messages_sent):
+        if not self.enabled:
+            return messages_sent
+        return {'sent': messages_sent, 'results': self.results}
+
+
+def chunk_results(result):
+    """
+    Returns the [position, status, detail] results of a chunk's task
+    'result', following deferred messages to the task they were queued in.
+    """
+    from celery.result import AsyncResult
+
+    if not result.ready():
+        return []
+    if not result.successful():
+        return None
+    value = result.result
+    if not isinstance(value, dict):
+        return []
+
+    results = []
+    for position, status, detail in value['results']:
+        results.append([position, status, detail])
+        if status == DEFERRED and detail:
+            results.extend(chunk_results(AsyncResult(detail, app=result.app)) or [])
+    return results
+
+
+class SendResults(list):
+    """
+    The AsyncResults of the chunks queued by CeleryEmailBackend.send_messages,
+    which also knows which messages went into which chunk.
+    """
+    def __init__(self, *args):
+        super(SendResults, self).__init__(*args)
+        self.chunk_indexes = []
+        self.scheduled_indexes = []
+
+    def message_results(self):
+        """
+        Returns a (status, detail) pair for every message passed to
+        send_messages, in the same order. Messages whose task has not
+        finished yet are PENDING, the ones of a task which raised FAILED and
+        the ones waiting in the outbox for their 'send_at' time SCHEDULED.
+        Requires CELERY_EMAIL_TRACK_RESULTS and a result backend.
+        """
+        statuses = dict((index, (SCHEDULED, None)) for index in self.scheduled_indexes)
+        for indexes, result in zip(self.chunk_indexes, self):
+            results = chunk_results(result)
+            default = (PENDING, None) if results is not None else (FAILED, None)
+            for index in indexes:
+                statuses[index] = default
+            for position, status, detail in results or []:
+                statuses[indexes[position]] = (status, detail)
+        return [statuses[index] for index in sorted(statuses)]
@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+# Sent for every metric recorded by djcelery_email.metrics.record with the
+# keyword arguments 'name', 'value', 'kind' ('timing' in seconds, 'size' in
+# bytes or 'counter') and 'tags'.
+metric_recorded = Signal()
@@ -1,11 +1,32 @@
+import json
+from collections import OrderedDict
+
 from django.conf import settings
-from django.core.mail import EmailMessage, get_connection
+from django.core.mail import EmailMessage
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 
 from celery import shared_task
 
+try:
+    from celery_batches import Batches
+except ImportError:
+    Batches = None
+
 # Make sure our AppConf is loaded properly.
 import djcelery_email.conf  # noqa
-from djcelery_email.utils import dict_to_email, email_to_dict
+from djcelery_email.aio import AsyncSMTPEngine
+from djcelery_email.balancer import get_balancer
+from djcelery_email.circuit import BackendUnavailable, get_circuit_breaker, is_message_error
+from djcelery_email.idempotency import get_idempotency_guard, templated_idempotency_key
+from djcelery_email.metrics import record, timer
+from djcelery_email.payload import decode_messages, is_encoded
+from djcelery_email.pool import ConnectionPool, connection_pool
+from djcelery_email.ratelimit import rate_limit
+from djcelery_email.results import DEFERRED, FAILED, RETRIED, SENT, SKIPPED, ResultTracker, smtp_code
+from djcelery_email.templated import render_templated_email
+from djcelery_email.utils import dict_to_email, email_to_dict, retry_countdown, retry_message
 
 # Messages *must* be dicts, not instances of the EmailMessage class
 # This is because we expect Celery to use JSON encoding, and we want to prevent
@@ -19,33 +40,408 @@ if 'base' in TASK_CONFIG and isinstance(TASK_CONFIG['base'], str):
     from django.utils.module_loading import import_string
     TASK_CONFIG['base'] = import_string(TASK_CONFIG['base'])
 
+TEMPLATED_TASK_CONFIG = dict(TASK_CONFIG, name='djcelery_email_send_templated')
+OUTBOX_TASK_CONFIG = dict(TASK_CONFIG, name='djcelery_email_drain_outbox')
+COALESCED_TASK_CONFIG = dict(TASK_CONFIG, name='djcelery_email_send_coalesced', base=Batches,
+                             flush_every=settings.CELERY_EMAIL_COALESCE_FLUSH_EVERY,
+                             flush_interval=settings.CELERY_EMAIL_COALESCE_FLUSH_INTERVAL)
+
 
 @shared_task(**TASK_CONFIG)
-def send_emails(messages, backend_kwargs=None, **kwargs):
+def send_emails(messages, backend_kwargs=None, tracking=None, **kwargs):
     # backward compat: handle **kwargs and missing backend_kwargs
     combined_kwargs = {}
     if backend_kwargs is not None:
         combined_kwargs.update(backend_kwargs)
     combined_kwargs.update(kwargs)
 
+    # chunks may be encoded with CELERY_EMAIL_PAYLOAD_CODEC
+    if is_encoded(messages):
+        with timer('decode'):
+            messages = decode_messages(messages)
+
     # backward compat: catch single object or dict
     if isinstance(messages, (EmailMessage, dict)):
         messages = [messages]
 
     # make sure they're all dicts
     messages = [email_to_dict(m) for m in messages]
+    tracker = ResultTracker(len(messages), tracking)
+
+    allowed, deferrals = rate_limit(messages)
+    if deferrals:
+        for countdown, deferred in deferrals:
+            result = _defer(send_emails, [[messages[index] for index in deferred], combined_kwargs],
+                            len(deferred), countdown, tracker.follow_up(deferred))
+            tracker.mark(deferred, DEFERRED, result.id)
+        tracker.keep(allowed)
+        messages = [messages[index] for index in allowed]
+        if not messages:
+            return tracker.result(0)
+
+    guard = get_idempotency_guard()
+    if guard is not None:
+        claimed = _claim(guard, messages)
+        tracker.mark(sorted(set(range(len(messages))) - set(claimed)), SKIPPED)
+        tracker.keep(claimed)
+        messages = [messages[index] for index in claimed]
+        if not messages:
+            return tracker.result(0)
+
+    try:
+        messages_sent, failed = _deliver(messages, combined_kwargs)
+    except BackendUnavailable as e:
+        if guard is not None:
+            guard.finish(messages, range(len(messages)))
+        everything = range(len(messages))
+        if tracker.enabled and _retries_exhausted(send_emails):
+            tracker.mark(everything, FAILED)
+            return tracker.result(0)
+        # defer the whole chunk in a single retry
+        record('messages_retried', len(messages))
+        send_emails.retry([messages, combined_kwargs], tracker.follow_up(everything, retry=True), exc=e,
+                          countdown=max(e.retry_after, _retry_countdown(send_emails)), throw=False)
+        tracker.mark(everything, RETRIED)
+        return tracker.result(0)
+    if guard is not None:
+        guard.finish(messages, [index for index, exc in failed])
+
+    failed_indexes = [index for index, exc in failed]
+    tracker.mark(sorted(set(range(len(messages))) - set(failed_indexes)), SENT)
+    if failed and tracker.enabled and _retries_exhausted(send_emails):
+        for index, exc in failed:
+            tracker.mark([index], FAILED, smtp_code(exc))
+    elif failed:
+        # retry all failed messages in a single task
+        retry_messages = [retry_message(messages[index], exc) for index, exc in failed]
+        record('messages_retried', len(retry_messages))
+        send_emails.retry([retry_messages, combined_kwargs], tracker.follow_up(failed_indexes, retry=True),
+                          exc=failed[-1][1], countdown=_retry_countdown(send_emails), throw=False)
+        for index, exc in failed:
+            tracker.mark([index], RETRIED, smtp_code(exc))
+    return tracker.result(messages_sent)
+
+
+@shared_task(**TEMPLATED_TASK_CONFIG)
+def send_templated_emails(template, recipients, backend_kwargs=None):
+    """
+    Renders and sends one message per [recipient_list, context] pair in
+    'recipients', see djcelery_email.templated.send_templated_mass_mail.
+    """
+    backend_kwargs = backend_kwargs or {}
+    messages = [render_templated_email(template, recipient_list, context)
+                for recipient_list, context in recipients]
+
+    allowed, deferrals = rate_limit(messages)
+    if deferrals:
+        for countdown, deferred in deferrals:
+            _defer(send_templated_emails, [template, [recipients[index] for index in deferred], backend_kwargs],
+                   len(deferred), countdown)
+        messages = [messages[index] for index in allowed]
+        recipients = [recipients[index] for index in allowed]
+        if not messages:
+            return 0
+
+    guard = get_idempotency_guard()
+    if guard is not None and send_templated_emails.request.id:
+        for message, (recipient_list, context) in zip(messages, recipients):
+            message['idempotency_key'] = templated_idempotency_key(
+                send_templated_emails.request.id, recipient_list, context)
+        claimed = _claim(guard, messages)
+        messages = [messages[index] for index in claimed]
+        recipients = [recipients[index] for index in claimed]
+        if not messages:
+            return 0
 
-    conn = get_connection(backend=settings.CELERY_EMAIL_BACKEND, **combined_kwargs)
     try:
-        conn.open()
-    except Exception:
-        logger.exception("Cannot reach CELERY_EMAIL_BACKEND %s", settings.CELERY_EMAIL_BACKEND)
+        messages_sent, failed = _deliver(messages, backend_kwargs)
+    except BackendUnavailable as e:
+        if guard is not None:
+            guard.finish(messages, range(len(messages)))
+        record('messages_retried', len(messages))
+        send_templated_emails.retry([template, recipients, backend_kwargs], exc=e,
+                                    countdown=max(e.retry_after, _retry_countdown(send_templated_emails)),
+                                    throw=False)
+        return 0
+    if guard is not None:
+        guard.finish(messages, [index for index, exc in failed])
+    if failed:
+        # retry all failed recipients in a single task, rendering them again
+        failed_recipients = [[retry_message(messages[index], exc)['to'], recipients[index][1]]
+                             for index, exc in failed]
+        record('messages_retried', len(failed_recipients))
+        send_templated_emails.retry([template, failed_recipients, backend_kwargs], exc=failed[-1][1],
+                                    countdown=_retry_countdown(send_templated_emails), throw=False)
+    return messages_sent
+
+
+@shared_task(**OUTBOX_TASK_CONFIG)
+def drain_outbox():
+    """
+    Publishes the messages written with CELERY_EMAIL_OUTBOX, and the
+    scheduled messages whose 'send_at' time has come, as send_emails
+    chunks. Rows are claimed CELERY_EMAIL_OUTBOX_BATCH_SIZE at a time with
+    SELECT ... FOR UPDATE SKIP LOCKED, so several drains can run at once,
+    and deleted in the same transaction their chunks were published in.
+    """
+    from djcelery_email.backends import CeleryEmailBackend
+    from djcelery_email.models import OutboxMessage
+
+    batch_size = settings.CELERY_EMAIL_OUTBOX_BATCH_SIZE
+    drained = 0
+    while True:
+        with transaction.atomic():
+            due = Q(send_at__isnull=True) | Q(send_at__lte=timezone.now())
+            rows = list(OutboxMessage.objects.select_for_update(skip_locked=True).filter(due)[:batch_size])
+            by_backend = {}
+            for row in rows:
+                by_backend.setdefault((row.backend_kwargs, row.lane), []).append(json.loads(row.message))
+            for (backend_kwargs, lane), messages in by_backend.items():
+                CeleryEmailBackend(lane=lane or None, **json.loads(backend_kwargs)).stream_messages(messages)
+            OutboxMessage.objects.filter(pk__in=[row.pk for row in rows]).delete()
+        drained += len(rows)
+        if len(rows) < batch_size:
+            break
+    if drained:
+        logger.info("Drained %d email messages from the outbox.", drained)
+    return drained
+
+
+if Batches is not None:
+    @shared_task(**COALESCED_TASK_CONFIG)
+    def send_coalesced_emails(requests):
+        """
+        Gathers the single message chunks queued with CELERY_EMAIL_COALESCE
+        for up to CELERY_EMAIL_COALESCE_FLUSH_INTERVAL seconds or
+        CELERY_EMAIL_COALESCE_FLUSH_EVERY tasks, see send_coalesced.
+        """
+        return send_coalesced(requests)
+else:
+    send_coalesced_emails = None
+
+
+def send_coalesced(requests):
+    """
+    Sends the messages of the (messages, backend_kwargs) task 'requests'
+    gathered by send_coalesced_emails, merged into one chunk per backend
+    kwargs and route, so each is sent over a single connection. Messages
+    which are deferred or fail are handed over to send_emails, which
+    retries them from then on. Returns the number of messages sent.
+    """
+    merged = OrderedDict()
+    for request in requests:
+        messages = request.args[0]
+        backend_kwargs = request.args[1] if len(request.args) > 1 else request.kwargs.get('backend_kwargs')
+        if is_encoded(messages):
+            messages = decode_messages(messages)
+        if isinstance(messages, dict):
+            messages = [messages]
+        key = (json.dumps(backend_kwargs or {}, sort_keys=True),
+               json.dumps(_delivery_options(request.delivery_info), sort_keys=True))
+        merged.setdefault(key, []).extend(email_to_dict(m) for m in messages)
 
     messages_sent = 0
+    for (backend_kwargs, options), messages in merged.items():
+        messages_sent += _send_coalesced_chunk(messages, json.loads(backend_kwargs), json.loads(options))
+    return messages_sent
+
+
+def _send_coalesced_chunk(messages, backend_kwargs, options):
+    allowed, deferrals = rate_limit(messages)
+    if deferrals:
+        for countdown, deferred in deferrals:
+            _defer(send_emails, [[messages[index] for index in deferred], backend_kwargs], len(deferred),
+                   countdown, options=options)
+        messages = [messages[index] for index in allowed]
+
+    guard = get_idempotency_guard()
+    if guard is not None and messages:
+        messages = [messages[index] for index in _claim(guard, messages)]
+    if not messages:
+        return 0
+
+    try:
+        messages_sent, failed = _deliver(messages, backend_kwargs)
+    except BackendUnavailable as e:
+        if guard is not None:
+            guard.finish(messages, range(len(messages)))
+        _hand_over(messages, backend_kwargs, max(e.retry_after, _retry_countdown(send_emails)), options)
+        return 0
+    if guard is not None:
+        guard.finish(messages, [index for index, exc in failed])
+    if failed:
+        _hand_over([retry_message(messages[index], exc) for index, exc in failed], backend_kwargs,
+                   _retry_countdown(send_emails), options)
+    return messages_sent
+
+
+def _hand_over(messages, backend_kwargs, countdown, options):
+    """ Queues messages a coalesced chunk could not send in a send_emails task. """
+    logger.info("Handing %d email messages over to a send_emails task in %.1f seconds.", len(messages), countdown)
+    record('messages_retried', len(messages))
+    return send_emails.apply_async([messages, backend_kwargs], countdown=countdown, **options)
+
+
+def _claim(guard, messages):
+    """ Returns the indexes of the messages to send, skipping the ones which were sent before. """
+    claimed = guard.claim(messages)
+    skipped = len(messages) - len(claimed)
+    if skipped:
+        logger.info("Skipping %d email messages which were already sent or are being sent.", skipped)
+        record('messages_skipped', skipped)
+    return claimed
+
+
+def _defer(task, args, count, countdown, kwargs=None, options=None):
+    """
+    Queues messages over the CELERY_EMAIL_RATE_LIMITS again without using
+    up a retry, routed like the current task unless 'options' are given.
+    """
+    logger.info("Deferring %d email messages for %.1f seconds because of CELERY_EMAIL_RATE_LIMITS.",
+                count, countdown)
+    record('messages_deferred', count)
+    if options is None:
+        options = _delivery_options(task.request.delivery_info)
+    return task.apply_async(args, kwargs, countdown=countdown, **options)
 
-    for message in messages:
+
+def _delivery_options(delivery_info):
+    """
+    Returns the apply_async options which route a new task like the one
+    with 'delivery_info', keeping it in its CELERY_EMAIL_PRIORITY_LANES
+    queue and priority.
+    """
+    delivery_info = delivery_info or {}
+    return dict((key, delivery_info[key]) for key in ('exchange', 'routing_key', 'priority')
+                if delivery_info.get(key) is not None)
+
+
+def _retries_exhausted(task):
+    return task.max_retries is not None and task.request.retries >= task.max_retries
+
+
+def _retry_countdown(task):
+    delay = settings.CELERY_EMAIL_RETRY_DELAY
+    if delay is None:
+        delay = task.default_retry_delay
+    return retry_countdown(task.request.retries, delay)
+
+
+def _deliver(messages, backend_kwargs):
+    """
+    Sends message dicts over one connection to CELERY_EMAIL_BACKEND, or to
+    the CELERY_EMAIL_BACKENDS in the order their balancer picks.
+
+    Returns the number of messages sent and a list of (index, exception)
+    for the messages that failed. Raises BackendUnavailable if no backend
+    can be reached or their circuit breakers are open.
+    """
+    balancer = get_balancer()
+    if balancer is None:
+        messages_sent, failed = _deliver_to(settings.CELERY_EMAIL_BACKEND, messages, backend_kwargs)
+    else:
+        messages_sent, failed = _deliver_balanced(balancer, messages, backend_kwargs)
+    record('messages_sent', messages_sent)
+    record('messages_failed', len(failed))
+    return messages_sent, failed
+
+
+def _deliver_balanced(balancer, messages, backend_kwargs):
+    """
+    Tries the CELERY_EMAIL_BACKENDS one after the other, each with the
+    messages the ones before could not send or could not be reached for.
+    """
+    messages_sent = 0
+    indexes = list(range(len(messages)))
+    pending = messages
+    failed = None
+    unavailable = []
+    for relay in balancer.candidates(backend_kwargs):
+        if failed:
+            logger.info("Failing over %d email messages to CELERY_EMAIL_BACKENDS entry %s.", len(pending),
+                        relay.backend)
         try:
-            sent = conn.send_messages([dict_to_email(message)])
+            with balancer.sending(relay, len(pending)):
+                sent, relay_failed = _deliver_to(relay.backend, pending, relay.backend_kwargs(backend_kwargs))
+        except BackendUnavailable as e:
+            unavailable.append(e)
+            continue
+        messages_sent += sent
+        failed = [(indexes[index], exc) for index, exc in relay_failed]
+        if not failed:
+            break
+        pending = [retry_message(pending[index], exc) for index, exc in relay_failed]
+        indexes = [index for index, exc in failed]
+
+    if failed is None:
+        raise BackendUnavailable("None of the CELERY_EMAIL_BACKENDS can be reached.",
+                                 min(e.retry_after for e in unavailable))
+    return messages_sent, failed
+
+
+def _deliver_to(backend, messages, backend_kwargs):
+    """ Sends message dicts over one connection to 'backend', behind its circuit breaker. """
+    breaker = None
+    if settings.CELERY_EMAIL_CIRCUIT_BREAKER:
+        breaker = get_circuit_breaker(ConnectionPool.make_key(backend, backend_kwargs))
+        if not breaker.allow():
+            raise BackendUnavailable("Circuit breaker for %s is open." % backend, breaker.retry_after())
+
+    try:
+        if settings.CELERY_EMAIL_ENGINE == 'async':
+            messages_sent, failed = _deliver_async(messages, backend_kwargs)
+        else:
+            messages_sent, failed = _deliver_sync(backend, messages, backend_kwargs)
+    except BackendUnavailable:
+        if breaker is not None:
+            breaker.record_failure()
+        raise
+
+    if breaker is not None:
+        # refused recipients and the like are answers from a working backend
+        if messages and len(failed) == len(messages) and not all(is_message_error(exc) for index, exc in failed):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+    return messages_sent, failed
+
+
+def _deliver_sync(backend, messages, backend_kwargs):
+    # a pooled connection is already open, in which case open() is a no-op
+    conn = connection_pool.acquire(backend, **backend_kwargs)
+    try:
+        with timer('connection_open'):
+            conn.open()
+    except Exception as e:
+        logger.exception("Cannot reach email backend %s", backend)
+        connection_pool.release(conn, discard=True)
+        raise BackendUnavailable("Cannot reach email backend %s: %r" % (backend, e))
+
+    messages_sent = 0
+    failed = []
+    unsent = range(len(messages))
+
+    if settings.CELERY_EMAIL_BATCH_SEND and len(messages) > 1:
+        try:
+            with timer('deserialize'):
+                email_messages = [dict_to_email(message) for message in messages]
+            with timer('send_batch'):
+                sent = conn.send_messages(email_messages)
+            if sent is not None:
+                messages_sent += sent
+            unsent = []
+            logger.debug("Successfully sent %d email messages in one batch.", len(messages))
+        except Exception as e:
+            logger.warning("Failed to send %d email messages in one batch, sending them one by one. (%r)",
+                           len(messages), e)
+
+    for index in unsent:
+        message = messages[index]
+        try:
+            with timer('deserialize'):
+                email_message = dict_to_email(message)
+            with timer('send'):
+                sent = conn.send_messages([email_message])
             if sent is not None:
                 messages_sent += sent
             logger.debug("Successfully sent email message to %r.", message['to'])
@@ -54,10 +450,29 @@ def send_emails(messages, backend_kwargs=None, **kwargs):
             # could be any number of things, depending on the backend
             logger.warning("Failed to send email message to %r, retrying. (%r)",
                            message['to'], e)
-            send_emails.retry([[message], combined_kwargs], exc=e, throw=False)
+            failed.append((index, e))
 
-    conn.close()
-    return messages_sent
+    connection_pool.release(conn, len(messages))
+    return messages_sent, failed
+
+
+def _deliver_async(messages, backend_kwargs):
+    """ Like _deliver_sync, but over concurrent SMTP sessions, see djcelery_email.aio. """
+    with timer('deserialize'):
+        email_messages = [dict_to_email(message) for message in messages]
+    with timer('send_batch'):
+        results = AsyncSMTPEngine(**backend_kwargs).send(email_messages)
+
+    messages_sent = 0
+    failed = []
+    for index, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.warning("Failed to send email message to %r, retrying. (%r)",
+                           messages[index]['to'], result)
+            failed.append((index, result))
+        elif result:
+            messages_sent += 1
+    return messages_sent, failed
 
 
 # backwards compatibility
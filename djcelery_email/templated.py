@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.template.loader import render_to_string
+
+from djcelery_email.utils import chunked, email_to_dict
+
+
+def send_templated_mass_mail(template_name, recipients_with_context, subject='', from_email=None,
+                             html_template_name=None, subject_template_name=None, context=None,
+                             headers=None, chunk_size=None, backend_kwargs=None):
+    """
+    Queues one email per (recipient_list, context) pair in
+    'recipients_with_context', rendered from 'template_name' (and
+    'html_template_name' for an HTML alternative) by the Celery workers.
+
+    Only the template names and the per recipient contexts are sent through
+    the broker, so contexts must be serializable by Celery. 'context' is
+    shared by all recipients. Returns the list of AsyncResults.
+    """
+    from djcelery_email.tasks import send_templated_emails
+
+    template = {
+        'template_name': template_name,
+        'html_template_name': html_template_name,
+        'subject': subject,
+        'subject_template_name': subject_template_name,
+        'from_email': from_email,
+        'headers': headers,
+        'context': context,
+    }
+    result_tasks = []
+    recipients = ([recipient_list, recipient_context]
+                  for recipient_list, recipient_context in recipients_with_context)
+    for chunk in chunked(recipients, chunk_size or settings.CELERY_EMAIL_CHUNK_SIZE):
+        result_tasks.append(send_templated_emails.delay(template, chunk, backend_kwargs or {}))
+    return result_tasks
+
+
+def render_templated_email(template, recipient_list, context):
+    """ Renders a message dict for one recipient of send_templated_mass_mail. """
+    if isinstance(recipient_list, str):
+        recipient_list = [recipient_list]
+    full_context = dict(template.get('context') or {})
+    full_context.update(context or {})
+
+    subject = template.get('subject') or ''
+    if template.get('subject_template_name'):
+        # subjects must not contain newlines
+        subject = ' '.join(render_to_string(template['subject_template_name'], full_context).splitlines())
+    body = render_to_string(template['template_name'], full_context)
+
+    message = EmailMultiAlternatives(subject.strip(), body, template.get('from_email'), recipient_list,
+                                     headers=template.get('headers'))
+    if template.get('html_template_name'):
+        message.attach_alternative(render_to_string(template['html_template_name'], full_context), 'text/html')
+    return email_to_dict(message)
@@ -1,10 +1,21 @@
 import copy
 import base64
+import datetime
+import math
+import random
+import smtplib
+import uuid
 from email.mime.base import MIMEBase
+from email.utils import parseaddr
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.core.mail import EmailMultiAlternatives, EmailMessage
 
+from djcelery_email.attachments import check_key, get_attachment_store
+from djcelery_email.conf import resolved_setting
+from djcelery_email.mime import PrecompiledEmailMessage, PrecompiledEmailMultiAlternatives
+
 
 def chunked(iterator, chunksize):
     """
@@ -23,9 +34,115 @@ def chunked(iterator, chunksize):
         yield chunk
 
 
-def email_to_dict(message):
+def payload_size(obj):
+    """
+    Estimates the number of bytes 'obj' takes up in a serialized task payload.
+
+    >>> payload_size({'to': ['a@example.com'], 'body': 'hi'})
+    21
+    """
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(payload_size(key) + payload_size(value) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sum(payload_size(item) for item in obj)
+    return len(str(obj))
+
+
+def chunked_by_size(iterator, chunksize, max_bytes):
+    """
+    Yields items from 'iterator' in chunks of at most 'chunksize' items whose
+    combined payload_size() stays below 'max_bytes'. An item bigger than
+    'max_bytes' is yielded in a chunk of its own.
+
+    >>> list(chunked_by_size(['aa', 'bb', 'cccc', 'd'], chunksize=3, max_bytes=4))
+    [['aa', 'bb'], ['cccc'], ['d']]
+    """
+    chunk = []
+    chunk_bytes = 0
+    for item in iterator:
+        size = payload_size(item)
+        if chunk and (len(chunk) == chunksize or chunk_bytes + size > max_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(item)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def retry_countdown(retries, delay):
+    """
+    Returns the number of seconds to wait before retry number 'retries' + 1,
+    with exponential backoff and/or jitter as configured.
+    """
+    if settings.CELERY_EMAIL_RETRY_BACKOFF:
+        delay = min(delay * 2 ** retries, settings.CELERY_EMAIL_RETRY_BACKOFF_MAX)
+    if settings.CELERY_EMAIL_RETRY_JITTER:
+        delay = random.uniform(0, delay)
+    return delay
+
+
+def schedule_bucket(send_at, seconds):
+    """
+    Rounds 'send_at' up to the next multiple of 'seconds' since midnight, so
+    messages scheduled close together are released together.
+
+    >>> schedule_bucket(datetime.datetime(2020, 1, 1, 7, 59, 1), 60)
+    datetime.datetime(2020, 1, 1, 8, 0)
+    """
+    midnight = send_at.replace(hour=0, minute=0, second=0, microsecond=0)
+    buckets = math.ceil((send_at - midnight).total_seconds() / seconds)
+    return midnight + datetime.timedelta(seconds=buckets * seconds)
+
+
+def retry_message(message, exc):
+    """
+    Returns the message dict to retry after 'exc'. If the backend refused some
+    recipients, only those are kept.
+    """
+    if not isinstance(exc, smtplib.SMTPRecipientsRefused) or not exc.recipients:
+        return message
+
+    refused = set(parseaddr(addr)[1].lower() for addr in exc.recipients)
+    message = dict(message)
+    for field in ('to', 'cc', 'bcc'):
+        if message.get(field):
+            message[field] = [addr for addr in message[field] if parseaddr(addr)[1].lower() in refused]
+    return message
+
+
+@resolved_setting
+def extra_attributes():
+    return tuple(settings.CELERY_EMAIL_MESSAGE_EXTRA_ATTRIBUTES or ())
+
+
+@resolved_setting
+def message_attributes():
+    """ The items of a message dict which dict_to_email sets as attributes of the message. """
+    return frozenset(('content_subtype', 'mixed_subtype', 'idempotency_key') + extra_attributes())
+
+
+@resolved_setting
+def message_classes():
+    if settings.CELERY_EMAIL_PRECOMPILE_MIME:
+        return PrecompiledEmailMultiAlternatives, PrecompiledEmailMessage
+    return EmailMultiAlternatives, EmailMessage
+
+
+def email_to_dict(message, binary_attachments=None):
+    """
+    Turns 'message' into a dict which can be passed to the send_emails task.
+    Attachment contents are base64 encoded, unless 'binary_attachments'
+    (defaults to CELERY_EMAIL_BINARY_ATTACHMENTS) is set, in which case they
+    are kept as bytes for binary safe serializers like msgpack.
+    """
     if isinstance(message, dict):
         return message
+    if binary_attachments is None:
+        binary_attachments = settings.CELERY_EMAIL_BINARY_ATTACHMENTS
 
     message_dict = {'subject': message.subject,
                     'body': message.body,
@@ -46,6 +163,7 @@ def email_to_dict(message):
         message_dict["mixed_subtype"] = message.mixed_subtype
 
     attachments = message.attachments
+    store = get_attachment_store() if attachments else None
     for attachment in attachments:
         if isinstance(attachment, MIMEBase):
             filename = attachment.get_filename('')
@@ -56,36 +174,62 @@ def email_to_dict(message):
             # For a mimetype starting with text/, content is expected to be a string.
             if isinstance(binary_contents, str):
                 binary_contents = binary_contents.encode()
-        contents = base64.b64encode(binary_contents).decode('ascii')
+        if store is not None and len(binary_contents) >= settings.CELERY_EMAIL_ATTACHMENT_STORE_THRESHOLD:
+            # only a reference to the stored contents goes into the payload
+            contents = {'sha256': store.store(binary_contents), 'size': len(binary_contents)}
+        elif binary_attachments:
+            contents = binary_contents
+        else:
+            contents = base64.b64encode(binary_contents).decode('ascii')
         message_dict['attachments'].append((filename, contents, mimetype))
 
-    if settings.CELERY_EMAIL_MESSAGE_EXTRA_ATTRIBUTES:
-        for attr in settings.CELERY_EMAIL_MESSAGE_EXTRA_ATTRIBUTES:
-            if hasattr(message, attr):
-                message_dict[attr] = getattr(message, attr)
+    for attr in extra_attributes():
+        if hasattr(message, attr):
+            message_dict[attr] = getattr(message, attr)
+
+    if settings.CELERY_EMAIL_IDEMPOTENCY:
+        # a random key still identifies the message when its chunk is delivered again
+        message_dict['idempotency_key'] = getattr(message, 'idempotency_key', None) or uuid.uuid4().hex
 
     return message_dict
 
 
 def dict_to_email(messagedict):
-    message_kwargs = copy.deepcopy(messagedict)  # prevents missing items on retry
-
-    # remove items from message_kwargs until only valid EmailMessage/EmailMultiAlternatives kwargs are left
-    # and save the removed items to be used as EmailMessage/EmailMultiAlternatives attributes later
-    message_attributes = ['content_subtype', 'mixed_subtype']
-    if settings.CELERY_EMAIL_MESSAGE_EXTRA_ATTRIBUTES:
-        message_attributes.extend(settings.CELERY_EMAIL_MESSAGE_EXTRA_ATTRIBUTES)
+    # 'messagedict' is never modified, so it can be passed to a retry as is.
+    # Split it into valid EmailMessage/EmailMultiAlternatives kwargs and the
+    # items to be set as EmailMessage/EmailMultiAlternatives attributes later
+    attribute_names = message_attributes()
+    message_kwargs = {}
     attributes_to_copy = {}
-    for attr in message_attributes:
-        if attr in message_kwargs:
-            attributes_to_copy[attr] = message_kwargs.pop(attr)
+    for key, value in messagedict.items():
+        if key in attribute_names:
+            # extra attributes may be mutable and are set on the message as is
+            attributes_to_copy[key] = copy.deepcopy(value)
+        else:
+            message_kwargs[key] = value
 
-    # remove attachments from message_kwargs then reinsert after base64 decoding
-    attachments = message_kwargs.pop('attachments')
+    # EmailMessage copies the recipient lists, but keeps these as they are
+    if message_kwargs.get('headers'):
+        message_kwargs['headers'] = dict(message_kwargs['headers'])
+    if message_kwargs.get('alternatives'):
+        message_kwargs['alternatives'] = list(message_kwargs['alternatives'])
+
+    # replace attachments in message_kwargs with their base64 decoded contents,
+    # their binary contents or the contents loaded from the attachment store
+    attachments = message_kwargs.get('attachments') or []
     message_kwargs['attachments'] = []
+    store = None
     for attachment in attachments:
         filename, contents, mimetype = attachment
-        contents = base64.b64decode(contents.encode('ascii'))
+        if isinstance(contents, dict):
+            store = store or get_attachment_store()
+            if store is None:
+                raise ImproperlyConfigured("CELERY_EMAIL_ATTACHMENT_STORE is required to load stored attachments.")
+            contents = store.load(check_key(contents['sha256']))
+        elif isinstance(contents, (bytes, bytearray, memoryview)):
+            contents = bytes(contents)
+        else:
+            contents = base64.b64decode(contents.encode('ascii'))
 
         # For a mimetype starting with text/, content is expected to be a string.
         if mimetype and mimetype.startswith('text/'):
@@ -93,10 +237,11 @@ def dict_to_email(messagedict):
 
         message_kwargs['attachments'].append((filename, contents, mimetype))
 
+    multi_alternatives_class, message_class = message_classes()
     if 'alternatives' in message_kwargs:
-        message = EmailMultiAlternatives(**message_kwargs)
+        message = multi_alternatives_class(**message_kwargs)
     else:
-        message = EmailMessage(**message_kwargs)
+        message = message_class(**message_kwargs)
 
     # set attributes on message with items removed from message_kwargs earlier
     for attr, val in attributes_to_copy.items():
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import platform
+import sys
+
+import django
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the enqueue and send paths of django-celery-email.")
+    parser.add_argument('--full', action='store_true', help="include the slow, large cases")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+    django.setup()
+
+    import celery
+    from djcelery_email import __version__
+    from benchmarks.cases import run_all
+
+    report = {
+        'django_celery_email': __version__,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'celery': celery.__version__,
+        'full': args.full,
+        'results': run_all(full=args.full),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
@@ -34,6 +34,12 @@ setup(
         'celery>=4.0',
         'django-appconf',
     ],
+    extras_require={
+        'async': ['aiosmtplib'],
+        'batches': ['celery-batches'],
+        'msgpack': ['msgpack'],
+        'zstd': ['zstandard'],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Framework :: Django',
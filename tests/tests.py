@@ -1,17 +1,54 @@
+import datetime
 import json
+import re
 import os.path
+import shutil
+import smtplib
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
 from email.mime.image import MIMEImage
+from email.utils import parseaddr
 
 from django.core import mail
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
 from django.core.mail.backends.base import BaseEmailBackend
 from django.core.mail.backends import locmem
 from django.core.mail import EmailMultiAlternatives
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
 from django.test.utils import override_settings
 
 import celery
+from celery.result import AsyncResult
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    from aiosmtpd.controller import Controller
+    import aiosmtplib
+except ImportError:
+    Controller = aiosmtplib = None
 from djcelery_email import tasks
-from djcelery_email.utils import email_to_dict, dict_to_email
+from djcelery_email.aio import AsyncSMTPEngine
+from djcelery_email.attachments import FileSystemAttachmentStore
+from djcelery_email.mime import PrecompiledEmailMultiAlternatives, mime_cache
+from djcelery_email.models import OutboxMessage
+from djcelery_email.payload import decode_messages, encode_messages, is_encoded
+from djcelery_email.balancer import get_balancer
+from djcelery_email.circuit import BackendUnavailable, get_circuit_breaker, reset_circuit_breakers
+from djcelery_email.pool import ConnectionPool, connection_pool, close_pooled_connections
+from djcelery_email.ratelimit import local_rate_limiter, parse_rate, rate_limit
+from djcelery_email.signals import metric_recorded
+from djcelery_email.templated import send_templated_mass_mail
+from djcelery_email.utils import (chunked_by_size, email_to_dict, dict_to_email, extra_attributes,
+                                  message_attributes, retry_countdown, schedule_bucket)
 
 
 def even(n):
@@ -33,6 +70,15 @@ class TracingBackend(BaseEmailBackend):
         self.__class__.called = True
 
 
+class BatchTracingBackend(locmem.EmailBackend):
+    """ Records the number of messages of every send_messages call. """
+    batches = []
+
+    def send_messages(self, messages):
+        self.__class__.batches.append(len(messages))
+        return super(BatchTracingBackend, self).send_messages(messages)
+
+
 class UtilTests(TestCase):
     @override_settings(CELERY_EMAIL_MESSAGE_EXTRA_ATTRIBUTES=['extra_attribute'])
     def test_email_to_dict_extra_attrs(self):
@@ -48,6 +94,29 @@ class UtilTests(TestCase):
 
         self.assertEqual(email_to_dict(dict_to_email(msg_dict)), msg_dict)
 
+    @override_settings(CELERY_EMAIL_MESSAGE_EXTRA_ATTRIBUTES=['extra_attribute'])
+    def test_dict_to_email_leaves_dict_untouched(self):
+        msg = EmailMultiAlternatives('test', 'body', 'from@example.com', ['to@example.com'],
+                                     headers={'X-Test': '1'})
+        msg.attach_alternative('<p>body</p>', 'text/html')
+        msg.attach('file.txt', 'contents', 'text/plain')
+        msg.extra_attribute = {'name': 'val'}
+        msg_dict = json.loads(json.dumps(email_to_dict(msg)))
+        original = json.loads(json.dumps(msg_dict))
+
+        email = dict_to_email(msg_dict)
+        email.to.append('other@example.com')
+        email.extra_headers['X-Other'] = '2'
+        email.attach_alternative('<p>other</p>', 'text/html')
+        email.attach('other.txt', 'other', 'text/plain')
+        email.extra_attribute['name'] = 'other'
+
+        self.assertEqual(msg_dict, original)
+
+    def test_chunked_by_size(self):
+        chunks = list(chunked_by_size(['aa', 'bb', 'cc', 'dddddd', 'e'], chunksize=2, max_bytes=5))
+        self.assertEqual(chunks, [['aa', 'bb'], ['cc'], ['dddddd'], ['e']])
+
     def check_json_of_msg(self, msg):
         serialized = json.dumps(email_to_dict(msg))
         self.assertEqual(
@@ -84,6 +153,219 @@ class UtilTests(TestCase):
         self.check_json_of_msg(msg)
 
 
+@override_settings(CELERY_EMAIL_PRECOMPILE_MIME=True)
+class PrecompiledMIMETests(TestCase):
+    """
+    Tests that with CELERY_EMAIL_PRECOMPILE_MIME the MIME content of
+    messages which only differ in their headers is built once.
+    """
+    def setUp(self):
+        super(PrecompiledMIMETests, self).setUp()
+        mime_cache.clear()
+
+    def make_dict(self, to, body='body'):
+        msg = EmailMultiAlternatives('test', body, 'from@example.com', [to], headers={'X-Test': to})
+        msg.attach_alternative('<p>%s</p>' % body, 'text/html')
+        msg.attach('file.bin', b'\0' * 1000, 'application/octet-stream')
+        msg.attach('file.txt', 'caf\xe9\n' * 10, 'text/plain')
+        return email_to_dict(msg)
+
+    def normalize(self, message_bytes):
+        return re.sub(rb'=+\d+==|(Message-ID|Date): .*', b'', message_bytes)
+
+    def test_same_bytes(self):
+        msg_dict = self.make_dict('to@example.com')
+        with override_settings(CELERY_EMAIL_PRECOMPILE_MIME=False):
+            expected = dict_to_email(msg_dict).message()
+
+        for linesep in ('\r\n', '\n'):
+            for _ in range(2):
+                email = dict_to_email(msg_dict)
+                self.assertIsInstance(email, PrecompiledEmailMultiAlternatives)
+                self.assertEqual(self.normalize(email.message().as_bytes(linesep=linesep)),
+                                 self.normalize(expected.as_bytes(linesep=linesep)))
+
+    def test_content_reused(self):
+        first = dict_to_email(self.make_dict('jeff@example.com')).message()
+        second = dict_to_email(self.make_dict('walter@example.com')).message()
+        self.assertEqual(len(mime_cache._trees), 1)
+
+        self.assertEqual(first['To'], 'jeff@example.com')
+        self.assertEqual(second['To'], 'walter@example.com')
+        self.assertEqual(second['X-Test'], 'walter@example.com')
+        self.assertNotEqual(first['Message-ID'], second['Message-ID'])
+        self.assertEqual([part.get_payload(decode=True) for part in first.walk()],
+                         [part.get_payload(decode=True) for part in second.walk()])
+
+    @override_settings(CELERY_EMAIL_PRECOMPILE_MIME_CACHE_SIZE=2)
+    def test_cache_size(self):
+        for body in ('one', 'two', 'three', 'one'):
+            dict_to_email(self.make_dict('to@example.com', body)).message()
+        self.assertEqual(len(mime_cache._trees), 2)
+
+    def test_plain_message_not_cached(self):
+        msg = mail.EmailMessage('test', 'body', 'from@example.com', ['to@example.com'])
+        dict_to_email(email_to_dict(msg)).message()
+        self.assertEqual(len(mime_cache._trees), 0)
+
+
+class AttachmentStoreTests(TestCase):
+    """
+    Tests that big attachments are kept out of the message dicts when an
+    attachment store is configured.
+    """
+    def setUp(self):
+        super(AttachmentStoreTests, self).setUp()
+        self.location = tempfile.mkdtemp()
+        self.settings = override_settings(
+            CELERY_EMAIL_ATTACHMENT_STORE='djcelery_email.attachments.FileSystemAttachmentStore',
+            CELERY_EMAIL_ATTACHMENT_STORE_OPTIONS={'location': self.location},
+            CELERY_EMAIL_ATTACHMENT_STORE_THRESHOLD=100,
+        )
+        self.settings.enable()
+
+    def tearDown(self):
+        super(AttachmentStoreTests, self).tearDown()
+        self.settings.disable()
+        shutil.rmtree(self.location)
+
+    def make_message(self, contents, mimetype='application/octet-stream'):
+        msg = mail.EmailMessage('test', 'body', 'from@example.com', ['to@example.com'])
+        msg.attach('file.bin', contents, mimetype)
+        return msg
+
+    def test_big_attachment_stored(self):
+        contents = b'x' * 100
+        msg_dict = email_to_dict(self.make_message(contents))
+        filename, reference, mimetype = msg_dict['attachments'][0]
+        self.assertEqual(reference['size'], 100)
+        self.assertEqual(dict_to_email(json.loads(json.dumps(msg_dict))).attachments,
+                         [('file.bin', contents, 'application/octet-stream')])
+
+    def test_small_attachment_inlined(self):
+        msg_dict = email_to_dict(self.make_message(b'x' * 99))
+        self.assertIsInstance(msg_dict['attachments'][0][1], str)
+        self.assertEqual(os.listdir(self.location), [])
+
+    def test_text_attachment_stored(self):
+        contents = 'csv content\n' * 10
+        msg_dict = email_to_dict(self.make_message(contents, 'text/csv'))
+        self.assertIsInstance(msg_dict['attachments'][0][1], dict)
+        self.assertEqual(dict_to_email(msg_dict).attachments, [('file.bin', contents, 'text/csv')])
+
+    def test_identical_attachments_stored_once(self):
+        first = email_to_dict(self.make_message(b'y' * 500))
+        second = email_to_dict(self.make_message(b'y' * 500))
+        self.assertEqual(first['attachments'], second['attachments'])
+        [subdir] = os.listdir(self.location)
+        self.assertEqual(len(os.listdir(os.path.join(self.location, subdir))), 1)
+
+    def test_invalid_keys_rejected(self):
+        store = FileSystemAttachmentStore(self.location)
+        for key in ['/etc/hostname', '../' + 'a' * 61, 'A' * 64, 'a' * 63, None]:
+            self.assertRaises(ValueError, store.load, key)
+
+    def test_crafted_reference_rejected(self):
+        msg_dict = email_to_dict(self.make_message(b'x' * 99))
+        msg_dict['attachments'] = [('file.bin', {'sha256': '../../etc/hostname', 'size': 1}, 'text/plain')]
+        self.assertRaises(ValueError, dict_to_email, msg_dict)
+
+
+class PayloadCodecTests(TestCase):
+    """
+    Tests that chunks encoded with CELERY_EMAIL_PAYLOAD_CODEC decode to the
+    original message dicts.
+    """
+    def make_messages(self):
+        msgs = []
+        for i in range(3):
+            msg = EmailMultiAlternatives('subject %d' % i, 'body', 'from@example.com', ['to%d@example.com' % i])
+            msg.attach_alternative('<p>body</p>', 'text/html')
+            msgs.append(email_to_dict(msg))
+        return msgs
+
+    def test_no_codec(self):
+        msgs = self.make_messages()
+        self.assertIs(encode_messages(msgs), msgs)
+
+    @override_settings(CELERY_EMAIL_PAYLOAD_CODEC='zlib')
+    def test_roundtrip(self):
+        msgs = self.make_messages()
+        payload = json.loads(json.dumps(encode_messages(msgs)))
+        self.assertTrue(is_encoded(payload))
+        self.assertEqual(decode_messages(payload), json.loads(json.dumps(msgs)))
+
+    @override_settings(CELERY_EMAIL_PAYLOAD_CODEC='zlib')
+    def test_task_accepts_encoded_chunk(self):
+        messages_sent = tasks.send_emails(encode_messages(self.make_messages()))
+        self.assertEqual(messages_sent, 3)
+        self.assertEqual([msg.to for msg in mail.outbox], [['to0@example.com'], ['to1@example.com'],
+                                                           ['to2@example.com']])
+        self.assertEqual(mail.outbox[2].alternatives, [['<p>body</p>', 'text/html']])
+
+    @override_settings(CELERY_EMAIL_PAYLOAD_CODEC='zlib')
+    def test_unknown_version(self):
+        payload = encode_messages(self.make_messages())
+        payload['djcelery_email_payload'] = 99
+        self.assertRaises(ValueError, decode_messages, payload)
+
+
+@override_settings(CELERY_EMAIL_BINARY_ATTACHMENTS=True)
+class BinaryAttachmentTests(TestCase):
+    """
+    Tests that with CELERY_EMAIL_BINARY_ATTACHMENTS attachment contents are
+    passed to the send_emails task as bytes.
+    """
+    contents = bytes(range(256)) * 4
+
+    def make_message(self):
+        msg = mail.EmailMessage('subject', 'body', 'from@example.com', ['to@example.com'])
+        msg.attach('data.bin', self.contents, 'application/octet-stream')
+        msg.attach('notes.txt', 'some notes', 'text/plain')
+        return msg
+
+    def test_roundtrip(self):
+        message_dict = email_to_dict(self.make_message())
+        self.assertEqual(message_dict['attachments'][0], ('data.bin', self.contents, 'application/octet-stream'))
+        self.assertEqual(dict_to_email(message_dict).attachments, [
+            ('data.bin', self.contents, 'application/octet-stream'),
+            ('notes.txt', 'some notes', 'text/plain'),
+        ])
+
+    def test_base64_contents_accepted(self):
+        """ Messages queued before the setting was turned on are still sent. """
+        message_dict = email_to_dict(self.make_message(), binary_attachments=False)
+        self.assertIsInstance(message_dict['attachments'][0][1], str)
+        self.assertEqual(dict_to_email(message_dict).attachments[0][1], self.contents)
+
+    @override_settings(CELERY_EMAIL_PAYLOAD_CODEC='zlib')
+    def test_encoded_payload(self):
+        payload = encode_messages([email_to_dict(self.make_message())])
+        self.assertIsInstance(payload['data'], bytes)
+        self.assertEqual(payload['blobs'], [self.contents, b'some notes'])
+        messages = decode_messages(payload)
+        self.assertEqual(dict_to_email(messages[0]).attachments[0][1], self.contents)
+
+    @unittest.skipIf(msgpack is None, "msgpack is required")
+    @override_settings(CELERY_EMAIL_PAYLOAD_CODEC='zlib')
+    def test_msgpack_serializer(self):
+        from kombu.serialization import dumps, loads
+
+        for payload in ([email_to_dict(self.make_message())], encode_messages([email_to_dict(self.make_message())])):
+            content_type, encoding, data = dumps(payload, serializer='msgpack')
+            payload = loads(data, content_type, encoding, accept=['msgpack'])
+            messages = decode_messages(payload) if is_encoded(payload) else payload
+            self.assertEqual(dict_to_email(messages[0]).attachments[0][1], self.contents)
+
+    def test_json_serializer_refused(self):
+        old_serializer = tasks.send_emails.serializer
+        tasks.send_emails.serializer = 'json'
+        try:
+            self.assertRaises(ImproperlyConfigured, mail.get_connection().send_messages, [self.make_message()])
+        finally:
+            tasks.send_emails.serializer = old_serializer
+
+
 class TaskTests(TestCase):
     """
     Tests that the 'tasks.send_email(s)' task works correctly:
@@ -180,6 +462,22 @@ class TaskTests(TestCase):
         tasks.send_email(email_to_dict(msg), foo='bar')
         self.assertEqual(TracingBackend.kwargs.get('foo'), 'bar')
 
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.BatchTracingBackend')
+    def test_send_one_by_one(self):
+        """ It should hand messages to the backend one at a time by default. """
+        BatchTracingBackend.batches = []
+        tasks.send_emails([mail.EmailMessage() for _ in range(3)])
+        self.assertEqual(BatchTracingBackend.batches, [1, 1, 1])
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.BatchTracingBackend', CELERY_EMAIL_BATCH_SEND=True)
+    def test_batch_send(self):
+        """ It should hand the whole chunk to the backend with CELERY_EMAIL_BATCH_SEND. """
+        BatchTracingBackend.batches = []
+        messages_sent = tasks.send_emails([mail.EmailMessage() for _ in range(3)])
+        self.assertEqual(BatchTracingBackend.batches, [3])
+        self.assertEqual(messages_sent, 3)
+        self.assertEqual(len(mail.outbox), 3)
+
 
 class EvenErrorBackend(locmem.EmailBackend):
     """ Fails to deliver every 2nd message. """
@@ -195,6 +493,27 @@ class EvenErrorBackend(locmem.EmailBackend):
             return super(EvenErrorBackend, self).send_messages(messages)
 
 
+class RefusingBackend(locmem.EmailBackend):
+    """ Refuses all recipients starting with 'refused', like smtplib does. """
+    def send_messages(self, messages):
+        refused = dict((addr, (550, b'mailbox unavailable')) for msg in messages for addr in msg.recipients()
+                       if parseaddr(addr)[1].lower().startswith('refused'))
+        if refused:
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return super(RefusingBackend, self).send_messages(messages)
+
+
+class UnreachableBackend(locmem.EmailBackend):
+    """ Fails to open connections while 'unreachable' is set. """
+    unreachable = True
+    opened = 0
+
+    def open(self):
+        self.__class__.opened += 1
+        if self.unreachable:
+            raise ConnectionRefusedError("Connection refused")
+
+
 class TaskErrorTests(TestCase):
     """
     Tests that the 'tasks.send_emails' task does not crash if a single message
@@ -215,6 +534,7 @@ class TaskErrorTests(TestCase):
     def tearDown(self):
         super(TaskErrorTests, self).tearDown()
         tasks.send_emails.retry = self._old_retry
+        reset_circuit_breakers()
 
     @override_settings(CELERY_EMAIL_BACKEND='tests.tests.EvenErrorBackend')
     def test_send_multiple_emails(self):
@@ -230,15 +550,748 @@ class TaskErrorTests(TestCase):
             ["msg 1", "msg 3", "msg 5", "msg 7", "msg 9"]
         )
 
-        # Assert that "even"/bad messages have been requeued,
-        # one retry task per bad message.
-        self.assertEqual(len(self._retry_calls), 5)
+        # Assert that "even"/bad messages have been requeued
+        # together in a single retry task.
+        self.assertEqual(len(self._retry_calls), 1)
         odd_msgs = [msg for idx, msg in enumerate(msgs) if even(idx)]
-        for msg, (args, kwargs) in zip(odd_msgs, self._retry_calls):
-            retry_args = args[0]
-            self.assertEqual(retry_args, [[email_to_dict(msg)], {'foo': 'bar'}])
-            self.assertTrue(isinstance(kwargs.get('exc'), RuntimeError))
-            self.assertFalse(kwargs.get('throw', True))
+        args, kwargs = self._retry_calls[0]
+        retry_args = args[0]
+        self.assertEqual(retry_args, [[email_to_dict(msg) for msg in odd_msgs], {'foo': 'bar'}])
+        self.assertTrue(isinstance(kwargs.get('exc'), RuntimeError))
+        self.assertEqual(kwargs.get('countdown'), tasks.send_emails.default_retry_delay)
+        self.assertFalse(kwargs.get('throw', True))
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.UnreachableBackend')
+    def test_unreachable_backend_defers_chunk(self):
+        UnreachableBackend.unreachable = True
+        msgs = [email_to_dict(mail.EmailMessage(subject="msg %d" % i)) for i in range(3)]
+        self.assertEqual(tasks.send_emails(msgs), 0)
+        self.assertEqual(len(mail.outbox), 0)
+        [(args, kwargs)] = self._retry_calls
+        self.assertEqual(args[0], [msgs, {}])
+        self.assertTrue(isinstance(kwargs['exc'], BackendUnavailable))
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.UnreachableBackend', CELERY_EMAIL_CIRCUIT_BREAKER=True,
+                       CELERY_EMAIL_CIRCUIT_BREAKER_THRESHOLD=2, CELERY_EMAIL_CIRCUIT_BREAKER_RESET_TIMEOUT=600)
+    def test_circuit_breaker_opens(self):
+        UnreachableBackend.unreachable = True
+        UnreachableBackend.opened = 0
+        for _ in range(4):
+            tasks.send_emails([mail.EmailMessage()])
+        # the last two chunks were deferred without reaching out to the backend
+        self.assertEqual(UnreachableBackend.opened, 2)
+        self.assertEqual(len(self._retry_calls), 4)
+        self.assertGreater(self._retry_calls[-1][1]['countdown'], 500)
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.UnreachableBackend', CELERY_EMAIL_CIRCUIT_BREAKER=True,
+                       CELERY_EMAIL_CIRCUIT_BREAKER_THRESHOLD=1, CELERY_EMAIL_CIRCUIT_BREAKER_RESET_TIMEOUT=0,
+                       CELERY_EMAIL_CIRCUIT_BREAKER_PROBE_SUCCESSES=2)
+    def test_circuit_breaker_closes_after_probes(self):
+        UnreachableBackend.unreachable = True
+        tasks.send_emails([mail.EmailMessage()])
+        breaker = get_circuit_breaker(ConnectionPool.make_key('tests.tests.UnreachableBackend', {}))
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        UnreachableBackend.unreachable = False
+        tasks.send_emails([mail.EmailMessage()])
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        tasks.send_emails([mail.EmailMessage()])
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual(len(mail.outbox), 2)
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.RefusingBackend', CELERY_EMAIL_CIRCUIT_BREAKER=True,
+                       CELERY_EMAIL_CIRCUIT_BREAKER_THRESHOLD=2, CELERY_EMAIL_CIRCUIT_BREAKER_RESET_TIMEOUT=600)
+    def test_refused_recipients_keep_circuit_closed(self):
+        """ Chunks whose recipients were all refused do not count against the backend. """
+        for i in range(5):
+            tasks.send_emails([mail.EmailMessage(to=['refused%d@example.com' % i])])
+        breaker = get_circuit_breaker(ConnectionPool.make_key('tests.tests.RefusingBackend', {}))
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+        self.assertEqual(tasks.send_emails([mail.EmailMessage(to=['ok@example.com'])]), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue(all(isinstance(kwargs['exc'], smtplib.SMTPRecipientsRefused)
+                            for args, kwargs in self._retry_calls))
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.RefusingBackend')
+    def test_retry_refused_recipients_only(self):
+        msg = mail.EmailMessage(to=['Ok <ok@example.com>', 'Refused <refused@example.com>'],
+                                cc=['ok2@example.com'], bcc=['REFUSED2@example.com'])
+        tasks.send_emails([msg])
+
+        [(args, kwargs)] = self._retry_calls
+        [retry_msg] = args[0][0]
+        self.assertEqual(retry_msg['to'], ['Refused <refused@example.com>'])
+        self.assertEqual(retry_msg['cc'], [])
+        self.assertEqual(retry_msg['bcc'], ['REFUSED2@example.com'])
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.EvenErrorBackend', CELERY_EMAIL_RETRY_DELAY=10)
+    def test_retry_delay(self):
+        tasks.send_emails([mail.EmailMessage()])
+        self.assertEqual(self._retry_calls[0][1]['countdown'], 10)
+
+    @override_settings(CELERY_EMAIL_RETRY_BACKOFF=True, CELERY_EMAIL_RETRY_BACKOFF_MAX=30)
+    def test_retry_backoff(self):
+        self.assertEqual([retry_countdown(retries, 10) for retries in range(4)], [10, 20, 30, 30])
+
+    @override_settings(CELERY_EMAIL_RETRY_JITTER=True)
+    def test_retry_jitter(self):
+        countdowns = set(retry_countdown(0, 10) for _ in range(20))
+        self.assertTrue(all(0 <= countdown <= 10 for countdown in countdowns))
+        self.assertGreater(len(countdowns), 1)
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.EvenErrorBackend', CELERY_EMAIL_BATCH_SEND=True)
+    def test_batch_send_falls_back_to_single_messages(self):
+        N = 4
+        msgs = [mail.EmailMessage(subject="msg %d" % i) for i in range(N)]
+        messages_sent = tasks.send_emails([email_to_dict(msg) for msg in msgs])
+
+        # The batch call fails, then every 2nd single message call fails.
+        self.assertEqual(messages_sent, 2)
+        self.assertEqual([msg.subject for msg in mail.outbox], ["msg 0", "msg 2"])
+        [(args, kwargs)] = self._retry_calls
+        self.assertEqual([msg['subject'] for msg in args[0][0]], ["msg 1", "msg 3"])
+
+
+@override_settings(CELERY_EMAIL_IDEMPOTENCY=True)
+class IdempotencyTests(TestCase):
+    """
+    Tests that with CELERY_EMAIL_IDEMPOTENCY messages are sent only once,
+    however often their chunk is delivered.
+    """
+    def setUp(self):
+        super(IdempotencyTests, self).setUp()
+        caches['default'].clear()
+
+        self._retry_calls = []
+
+        def mock_retry(*args, **kwargs):
+            self._retry_calls.append((args, kwargs))
+
+        self._old_retry = tasks.send_emails.retry
+        tasks.send_emails.retry = mock_retry
+
+    def tearDown(self):
+        super(IdempotencyTests, self).tearDown()
+        tasks.send_emails.retry = self._old_retry
+
+    def test_redelivered_chunk(self):
+        msgs = [email_to_dict(mail.EmailMessage('msg %d' % i, to=['to@example.com'])) for i in range(3)]
+        self.assertEqual(len(set(msg['idempotency_key'] for msg in msgs)), 3)
+
+        self.assertEqual(tasks.send_emails(msgs), 3)
+        self.assertEqual(tasks.send_emails(msgs), 0)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_caller_key(self):
+        msgs = []
+        for i in range(2):
+            msg = mail.EmailMessage('msg %d' % i, to=['to@example.com'])
+            msg.idempotency_key = 'welcome-42'
+            msgs.append(email_to_dict(msg))
+
+        self.assertEqual(tasks.send_emails(msgs), 1)
+        self.assertEqual([msg.subject for msg in mail.outbox], ['msg 0'])
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.EvenErrorBackend')
+    def test_failed_messages_released(self):
+        msgs = [email_to_dict(mail.EmailMessage('msg %d' % i, to=['to@example.com'])) for i in range(4)]
+        self.assertEqual(tasks.send_emails(msgs), 2)
+        [(args, kwargs)] = self._retry_calls
+        self.assertEqual(args[0][0], [msgs[0], msgs[2]])
+
+        with override_settings(CELERY_EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            self.assertEqual(tasks.send_emails(msgs), 2)
+        self.assertEqual(sorted(msg.subject for msg in mail.outbox), ['msg 0', 'msg 1', 'msg 2', 'msg 3'])
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.UnreachableBackend')
+    def test_unreachable_backend_releases_chunk(self):
+        UnreachableBackend.unreachable = True
+        msgs = [email_to_dict(mail.EmailMessage('msg', to=['to@example.com']))]
+        self.assertEqual(tasks.send_emails(msgs), 0)
+        with override_settings(CELERY_EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            self.assertEqual(tasks.send_emails(msgs), 1)
+
+
+@override_settings(CELERY_EMAIL_TRACK_RESULTS=True)
+class ResultTrackingTests(TestCase):
+    """
+    Tests that with CELERY_EMAIL_TRACK_RESULTS the tasks return a result per
+    message, which the results of send_messages map back to the messages.
+    """
+    def setUp(self):
+        super(ResultTrackingTests, self).setUp()
+        self._retry_calls = []
+
+        def mock_retry(*args, **kwargs):
+            self._retry_calls.append((args, kwargs))
+
+        self._old_retry = tasks.send_emails.retry
+        tasks.send_emails.retry = mock_retry
+
+    def tearDown(self):
+        super(ResultTrackingTests, self).tearDown()
+        tasks.send_emails.retry = self._old_retry
+        celery.current_app.conf.task_always_eager = False
+
+    def make_messages(self, count):
+        return [email_to_dict(mail.EmailMessage('msg %d' % i, to=['to@example.com'])) for i in range(count)]
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.EvenErrorBackend')
+    def test_retried_messages(self):
+        result = tasks.send_emails(self.make_messages(4))
+        self.assertEqual(result, {'sent': 2, 'results': [
+            [1, 'sent', None], [3, 'sent', None], [0, 'retried', None], [2, 'retried', None]]})
+
+        [(args, kwargs)] = self._retry_calls
+        retry_messages, retry_kwargs = args
+        self.assertEqual(retry_kwargs, {'tracking': {
+            'positions': [0, 2], 'results': [[1, 'sent', None], [3, 'sent', None]]}})
+
+        # the retry reports the results of the whole chunk
+        with override_settings(CELERY_EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            result = tasks.send_emails(*retry_messages, **retry_kwargs)
+        self.assertEqual(result, {'sent': 2, 'results': [
+            [1, 'sent', None], [3, 'sent', None], [0, 'sent', None], [2, 'sent', None]]})
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.RefusingBackend')
+    def test_retries_exhausted(self):
+        messages = self.make_messages(1)
+        messages[0]['to'] = ['refused@example.com']
+        result = tasks.send_emails.apply([messages], retries=tasks.send_emails.max_retries).get()
+        self.assertEqual(result, {'sent': 0, 'results': [[0, 'failed', 550]]})
+        self.assertEqual(self._retry_calls, [])
+
+    @override_settings(CELERY_EMAIL_RATE_LIMITS={'slow.example.com': '1/h'})
+    def test_deferred_messages(self):
+        local_rate_limiter._buckets.clear()
+        messages = self.make_messages(3)
+        for message in messages:
+            message['to'] = ['to@slow.example.com']
+
+        calls = []
+
+        def mock_apply_async(args, kwargs=None, **options):
+            calls.append((args, kwargs))
+            return AsyncResult('deferred-task-%d' % len(calls))
+
+        old_apply_async = tasks.send_emails.apply_async
+        tasks.send_emails.apply_async = mock_apply_async
+        try:
+            result = tasks.send_emails(messages)
+        finally:
+            tasks.send_emails.apply_async = old_apply_async
+
+        # at one message per hour, the deferred messages are due an hour apart
+        self.assertEqual(result, {'sent': 1, 'results': [
+            [1, 'deferred', 'deferred-task-1'], [2, 'deferred', 'deferred-task-2'], [0, 'sent', None]]})
+        self.assertEqual([kwargs for args, kwargs in calls], [{'tracking': {'positions': [1]}},
+                                                              {'tracking': {'positions': [2]}}])
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.RefusingBackend', CELERY_EMAIL_CHUNK_SIZE=2,
+                       CELERY_EMAIL_PRIORITY_LANES={'fast': {'chunk_size': 1}, 'slow': {}},
+                       CELERY_EMAIL_DEFAULT_LANE='slow')
+    def test_message_results(self):
+        celery.current_app.conf.task_always_eager = True
+        messages = []
+        for to, lane in [('a@example.com', None), ('b@example.com', 'fast'), ('refused@example.com', None),
+                         ('d@example.com', None)]:
+            msg = mail.EmailMessage('test', 'body', 'from@example.com', [to])
+            if lane:
+                msg.lane = lane
+            messages.append(msg)
+
+        results = mail.get_connection().send_messages(messages)
+        self.assertEqual(results.chunk_indexes, [[1], [0, 2], [3]])
+        self.assertEqual(results.message_results(), [('sent', None), ('sent', None), ('retried', 550),
+                                                     ('sent', None)])
+
+
+class OpenCloseBackend(locmem.EmailBackend):
+    """ Counts how often connections are opened and closed. """
+    opened = closed = 0
+
+    def open(self):
+        self.__class__.opened += 1
+
+    def close(self):
+        self.__class__.closed += 1
+
+
+@override_settings(CELERY_EMAIL_BACKEND='tests.tests.OpenCloseBackend')
+class ConnectionPoolTests(TestCase):
+    """
+    Tests that connections are reused across tasks when
+    CELERY_EMAIL_CONNECTION_POOL is enabled.
+    """
+    def setUp(self):
+        super(ConnectionPoolTests, self).setUp()
+        OpenCloseBackend.opened = OpenCloseBackend.closed = 0
+
+    def tearDown(self):
+        super(ConnectionPoolTests, self).tearDown()
+        connection_pool.close_all()
+
+    def test_pool_disabled(self):
+        tasks.send_emails([mail.EmailMessage()])
+        tasks.send_emails([mail.EmailMessage()])
+        self.assertEqual(OpenCloseBackend.opened, 2)
+        self.assertEqual(OpenCloseBackend.closed, 2)
+
+    @override_settings(CELERY_EMAIL_CONNECTION_POOL=True)
+    def test_connection_reused(self):
+        tasks.send_emails([mail.EmailMessage()])
+        conn = connection_pool.acquire('tests.tests.OpenCloseBackend')
+        connection_pool.release(conn)
+        tasks.send_emails([mail.EmailMessage()])
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(OpenCloseBackend.closed, 0)
+        self.assertIs(connection_pool.acquire('tests.tests.OpenCloseBackend'), conn)
+
+    @override_settings(CELERY_EMAIL_CONNECTION_POOL=True)
+    def test_pool_keyed_by_backend_kwargs(self):
+        conn = connection_pool.acquire('tests.tests.OpenCloseBackend', foo='bar')
+        connection_pool.release(conn)
+        self.assertIsNot(connection_pool.acquire('tests.tests.OpenCloseBackend', foo='baz'), conn)
+        self.assertIs(connection_pool.acquire('tests.tests.OpenCloseBackend', foo='bar'), conn)
+
+    @override_settings(CELERY_EMAIL_CONNECTION_POOL=True, CELERY_EMAIL_CONNECTION_POOL_MAX_MESSAGES=3)
+    def test_connection_recycled_after_max_messages(self):
+        tasks.send_emails([mail.EmailMessage() for _ in range(2)])
+        self.assertEqual(OpenCloseBackend.closed, 0)
+        tasks.send_emails([mail.EmailMessage() for _ in range(2)])
+        self.assertEqual(OpenCloseBackend.closed, 1)
+
+    @override_settings(CELERY_EMAIL_CONNECTION_POOL=True, CELERY_EMAIL_CONNECTION_POOL_MAX_IDLE=-1)
+    def test_idle_connection_dropped(self):
+        tasks.send_emails([mail.EmailMessage()])
+        tasks.send_emails([mail.EmailMessage()])
+        self.assertEqual(OpenCloseBackend.opened, 2)
+        self.assertEqual(OpenCloseBackend.closed, 1)
+
+    @override_settings(CELERY_EMAIL_CONNECTION_POOL=True)
+    def test_closed_on_worker_shutdown(self):
+        tasks.send_emails([mail.EmailMessage()])
+        close_pooled_connections()
+        self.assertEqual(OpenCloseBackend.closed, 1)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class RelayBackend(locmem.EmailBackend):
+    """ Records which 'relay' it was created for sent which message. """
+    sent_via = []
+
+    def __init__(self, relay=None, **kwargs):
+        super(RelayBackend, self).__init__(**kwargs)
+        self.relay = relay
+
+    def send_messages(self, messages):
+        self.sent_via.extend((self.relay, message.subject) for message in messages)
+        return super(RelayBackend, self).send_messages(messages)
+
+
+def relay(name, weight=1, backend='tests.tests.RelayBackend'):
+    return {'backend': backend, 'kwargs': {'relay': name}, 'weight': weight}
+
+
+class BackendBalancerTests(TestCase):
+    """
+    Tests that with CELERY_EMAIL_BACKENDS chunks are spread over several
+    backends, failing over to the next one within the task.
+    """
+    def setUp(self):
+        super(BackendBalancerTests, self).setUp()
+        RelayBackend.sent_via = []
+        UnreachableBackend.unreachable = True
+        UnreachableBackend.opened = 0
+
+    def tearDown(self):
+        super(BackendBalancerTests, self).tearDown()
+        reset_circuit_breakers()
+
+    def send_chunks(self, count):
+        for i in range(count):
+            tasks.send_emails([email_to_dict(mail.EmailMessage('msg %d' % i, to=['to@example.com']))])
+        return [name for name, subject in RelayBackend.sent_via]
+
+    @override_settings(CELERY_EMAIL_BACKENDS=[relay('a', weight=2), relay('b')])
+    def test_weighted_round_robin(self):
+        self.assertEqual(self.send_chunks(6), ['a', 'b', 'a', 'a', 'b', 'a'])
+
+    @override_settings(CELERY_EMAIL_BACKENDS=[relay('a'), relay('b')], CELERY_EMAIL_BACKEND_SELECTION='least_loaded')
+    def test_least_loaded(self):
+        self.assertEqual(self.send_chunks(4), ['a', 'b', 'a', 'b'])
+
+        balancer = get_balancer()
+        first, second = balancer.relays
+        with balancer.sending(first, 10):
+            self.assertEqual(balancer.candidates({}), [second, first])
+
+    @override_settings(CELERY_EMAIL_BACKENDS=[relay('a', backend='tests.tests.UnreachableBackend'), relay('b')])
+    def test_failover_when_unreachable(self):
+        self.assertEqual(self.send_chunks(1), ['b'])
+        self.assertEqual(UnreachableBackend.opened, 1)
+
+    @override_settings(CELERY_EMAIL_BACKENDS=[relay('a', backend='tests.tests.EvenErrorBackend'), relay('b')])
+    def test_failover_of_failed_messages(self):
+        old_retry = tasks.send_emails.retry
+        tasks.send_emails.retry = lambda *args, **kwargs: self.fail("Failed messages should not be retried.")
+        try:
+            msgs = [email_to_dict(mail.EmailMessage('msg %d' % i, to=['to@example.com'])) for i in range(4)]
+            self.assertEqual(tasks.send_emails(msgs), 4)
+        finally:
+            tasks.send_emails.retry = old_retry
+        self.assertEqual(RelayBackend.sent_via, [('b', 'msg 0'), ('b', 'msg 2')])
+        self.assertEqual(len(mail.outbox), 4)
+
+    @override_settings(CELERY_EMAIL_BACKENDS=[relay('a', backend='tests.tests.UnreachableBackend'),
+                                              relay('b', backend='tests.tests.UnreachableBackend')])
+    def test_all_unreachable(self):
+        msgs = [email_to_dict(mail.EmailMessage('msg', to=['to@example.com']))]
+        self.assertRaises(BackendUnavailable, tasks._deliver, msgs, {})
+        self.assertEqual(UnreachableBackend.opened, 2)
+
+    @override_settings(CELERY_EMAIL_BACKENDS=[relay('a', backend='tests.tests.UnreachableBackend'), relay('b')],
+                       CELERY_EMAIL_CIRCUIT_BREAKER=True, CELERY_EMAIL_CIRCUIT_BREAKER_THRESHOLD=1,
+                       CELERY_EMAIL_CIRCUIT_BREAKER_RESET_TIMEOUT=600)
+    def test_open_circuit_tried_last(self):
+        self.assertEqual(self.send_chunks(3), ['b', 'b', 'b'])
+        self.assertEqual(UnreachableBackend.opened, 1)
+
+    @override_settings(CELERY_EMAIL_BACKENDS=[relay('a')], CELERY_EMAIL_BACKEND_SELECTION='random')
+    def test_unknown_selection(self):
+        self.assertRaises(ImproperlyConfigured, get_balancer)
+
+
+class QueuedRequest(object):
+    """ Stands in for the requests celery-batches passes to send_coalesced_emails. """
+    def __init__(self, messages, backend_kwargs=None, delivery_info=None):
+        self.args = (messages, backend_kwargs or {})
+        self.kwargs = {}
+        self.delivery_info = delivery_info or {}
+
+
+class RecordingTask(object):
+    """ Stands in for send_coalesced_emails, which needs celery-batches. """
+    def __init__(self):
+        self.calls = []
+
+    def delay(self, *args):
+        self.calls.append(args)
+        return AsyncResult('coalesced-%d' % len(self.calls))
+
+
+@override_settings(CELERY_EMAIL_BACKEND='tests.tests.OpenCloseBackend')
+class CoalescingTests(TestCase):
+    """
+    Tests that with CELERY_EMAIL_COALESCE single message chunks are queued
+    in send_coalesced_emails, which sends them over shared connections.
+    """
+    def setUp(self):
+        super(CoalescingTests, self).setUp()
+        OpenCloseBackend.opened = OpenCloseBackend.closed = 0
+
+    def make_request(self, i, backend_kwargs=None, delivery_info=None):
+        message = mail.EmailMessage('subject %d' % i, 'body', 'from@example.com', ['to%d@example.com' % i])
+        return QueuedRequest([email_to_dict(message)], backend_kwargs, delivery_info)
+
+    def test_merged_per_backend_kwargs(self):
+        requests = [self.make_request(0), self.make_request(1), self.make_request(2, {'username': 'user'}),
+                    self.make_request(3)]
+        self.assertEqual(tasks.send_coalesced(requests), 4)
+        self.assertEqual([msg.subject for msg in mail.outbox], ['subject 0', 'subject 1', 'subject 3', 'subject 2'])
+        self.assertEqual(OpenCloseBackend.opened, 2)
+
+    @override_settings(CELERY_EMAIL_PAYLOAD_CODEC='zlib')
+    def test_encoded_chunks(self):
+        requests = [self.make_request(i) for i in range(2)]
+        for request in requests:
+            request.args = (encode_messages(request.args[0]), request.args[1])
+        self.assertEqual(tasks.send_coalesced(requests), 2)
+        self.assertEqual(OpenCloseBackend.opened, 1)
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.EvenErrorBackend', CELERY_EMAIL_RETRY_DELAY=30)
+    def test_failed_handed_over(self):
+        calls = []
+        old_apply_async = tasks.send_emails.apply_async
+
+        def mock_apply_async(args, **options):
+            calls.append((args, options))
+            return AsyncResult('task-%d' % len(calls))
+        tasks.send_emails.apply_async = mock_apply_async
+        try:
+            delivery_info = {'routing_key': 'email_bulk', 'priority': 3, 'redelivered': False}
+            sent = tasks.send_coalesced([self.make_request(i, delivery_info=delivery_info) for i in range(3)])
+        finally:
+            tasks.send_emails.apply_async = old_apply_async
+
+        self.assertEqual(sent, 1)
+        self.assertEqual(len(calls), 1)
+        (messages, backend_kwargs), options = calls[0]
+        self.assertEqual([message['subject'] for message in messages], ['subject 0', 'subject 2'])
+        self.assertEqual(backend_kwargs, {})
+        self.assertEqual(options, {'countdown': 30, 'routing_key': 'email_bulk', 'priority': 3})
+
+    @override_settings(CELERY_EMAIL_COALESCE=True)
+    def test_backend_coalesces_single_messages(self):
+        delay_calls = []
+        coalesced = RecordingTask()
+        old_delay, old_coalesced = tasks.send_emails.delay, tasks.send_coalesced_emails
+
+        def mock_delay(*args):
+            delay_calls.append(args)
+            return AsyncResult('task-%d' % len(delay_calls))
+        tasks.send_emails.delay = mock_delay
+        tasks.send_coalesced_emails = coalesced
+        try:
+            mail.send_mail('single', 'body', 'from@example.com', ['to@example.com'])
+            mail.send_mass_mail([('mass', 'body', 'from@example.com', ['to@example.com'])] * 3)
+            with override_settings(CELERY_EMAIL_TRACK_RESULTS=True):
+                mail.send_mail('tracked', 'body', 'from@example.com', ['to@example.com'])
+        finally:
+            tasks.send_emails.delay = old_delay
+            tasks.send_coalesced_emails = old_coalesced
+
+        self.assertEqual([[message['subject'] for message in args[0]] for args in coalesced.calls], [['single']])
+        self.assertEqual([[message['subject'] for message in args[0]] for args in delay_calls],
+                         [['mass', 'mass', 'mass'], ['tracked']])
+
+    @override_settings(CELERY_EMAIL_COALESCE=True)
+    def test_requires_celery_batches(self):
+        old_coalesced = tasks.send_coalesced_emails
+        tasks.send_coalesced_emails = None
+        try:
+            self.assertRaises(ImproperlyConfigured, mail.send_mail,
+                              'subject', 'body', 'from@example.com', ['to@example.com'])
+        finally:
+            tasks.send_coalesced_emails = old_coalesced
+
+
+class RecordingHandler(object):
+    """ aiosmtpd handler recording envelopes and refusing 'refused@' recipients. """
+    def __init__(self):
+        self.envelopes = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith('refused@'):
+            return '550 mailbox unavailable'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.envelopes.append(envelope)
+        return '250 Message accepted for delivery'
+
+
+@unittest.skipIf(Controller is None or aiosmtplib is None, "aiosmtpd and aiosmtplib are required")
+class AsyncEngineTests(TestCase):
+    """
+    Tests that CELERY_EMAIL_ENGINE = 'async' sends chunks over concurrent SMTP
+    sessions and reports failed messages for retry.
+    """
+    def setUp(self):
+        super(AsyncEngineTests, self).setUp()
+        self.handler = RecordingHandler()
+        self.controller = Controller(self.handler, hostname='127.0.0.1', port=free_port())
+        self.controller.start()
+        self.settings = override_settings(
+            CELERY_EMAIL_ENGINE='async', EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.controller.port,
+            CELERY_EMAIL_ASYNC_MAX_SESSIONS=3)
+        self.settings.enable()
+
+        self._retry_calls = []
+
+        def mock_retry(*args, **kwargs):
+            self._retry_calls.append((args, kwargs))
+
+        self._old_retry = tasks.send_emails.retry
+        tasks.send_emails.retry = mock_retry
+
+    def tearDown(self):
+        super(AsyncEngineTests, self).tearDown()
+        tasks.send_emails.retry = self._old_retry
+        self.settings.disable()
+        self.controller.stop()
+
+    def test_send_chunk(self):
+        msgs = [mail.EmailMessage('msg %d' % i, 'body', 'from@example.com', ['to%d@example.com' % i])
+                for i in range(7)]
+        messages_sent = tasks.send_emails(msgs)
+        self.assertEqual(messages_sent, 7)
+        self.assertEqual(sorted(envelope.rcpt_tos[0] for envelope in self.handler.envelopes),
+                         sorted('to%d@example.com' % i for i in range(7)))
+
+    def test_failed_message_retried(self):
+        msgs = [mail.EmailMessage('msg', 'body', 'from@example.com', [to])
+                for to in ['to@example.com', 'refused@example.com', 'to@example.org']]
+        messages_sent = tasks.send_emails(msgs)
+        self.assertEqual(messages_sent, 2)
+        self.assertEqual(len(self._retry_calls), 1)
+        args, kwargs = self._retry_calls[0]
+        self.assertEqual(args[0][0][0]['to'], ['refused@example.com'])
+
+    @override_settings(CELERY_EMAIL_ASYNC_MAX_SESSIONS=10, CELERY_EMAIL_ASYNC_MAX_SESSIONS_PER_DOMAIN=10)
+    def test_refused_session_leaves_messages_to_others(self):
+        """ A session which cannot connect, e.g. for too many connections, hands its message to the others. """
+        connects = []
+        old_connect = AsyncSMTPEngine._connect
+
+        async def flaky_connect(engine):
+            connects.append(None)
+            if len(connects) == 2:
+                raise smtplib.SMTPConnectError(421, b'too many connections')
+            return await old_connect(engine)
+        AsyncSMTPEngine._connect = flaky_connect
+        try:
+            msgs = [email_to_dict(mail.EmailMessage('msg %d' % i, 'body', 'from@example.com', ['to@example.com']))
+                    for i in range(20)]
+            self.assertEqual(tasks.send_emails(msgs), 20)
+        finally:
+            AsyncSMTPEngine._connect = old_connect
+
+        self.assertEqual(len(connects), 10)
+        self.assertEqual(self._retry_calls, [])
+        self.assertEqual(len(self.handler.envelopes), 20)
+
+    def test_unreachable_server_defers_chunk(self):
+        """ A chunk for a server which is down is retried as a whole, without connecting for every message. """
+        connects = []
+        old_connect = AsyncSMTPEngine._connect
+
+        async def counting_connect(engine):
+            connects.append(None)
+            return await old_connect(engine)
+        AsyncSMTPEngine._connect = counting_connect
+        try:
+            with override_settings(EMAIL_PORT=free_port(), CELERY_EMAIL_ASYNC_MAX_SESSIONS=2):
+                msgs = [email_to_dict(mail.EmailMessage('msg %d' % i, 'body', 'from@example.com', ['to@example.com']))
+                        for i in range(6)]
+                self.assertEqual(tasks.send_emails(msgs), 0)
+        finally:
+            AsyncSMTPEngine._connect = old_connect
+
+        self.assertEqual(len(connects), 2)
+        [(args, kwargs)] = self._retry_calls
+        self.assertEqual(args[0], [msgs, {}])
+        self.assertTrue(isinstance(kwargs['exc'], BackendUnavailable))
+
+
+class RateLimitTests(TestCase):
+    """
+    Tests that messages over the CELERY_EMAIL_RATE_LIMITS are deferred to a
+    new task instead of being sent.
+    """
+    def setUp(self):
+        super(RateLimitTests, self).setUp()
+        self._apply_async_calls = []
+
+        def mock_apply_async(*args, **kwargs):
+            self._apply_async_calls.append((args, kwargs))
+            return AsyncResult('task-%d' % len(self._apply_async_calls))
+
+        self._old_apply_async = tasks.send_emails.apply_async
+        tasks.send_emails.apply_async = mock_apply_async
+        local_rate_limiter._buckets.clear()
+        caches['default'].clear()
+
+    def tearDown(self):
+        super(RateLimitTests, self).tearDown()
+        tasks.send_emails.apply_async = self._old_apply_async
+
+    def make_messages(self, *recipients):
+        return [email_to_dict(mail.EmailMessage('test', 'body', 'from@example.com', [to])) for to in recipients]
+
+    @override_settings(CELERY_EMAIL_RATE_LIMITS={'slow.example.com': '2/m'})
+    def test_per_domain_limit(self):
+        msgs = self.make_messages('a@slow.example.com', 'b@fast.example.com', 'c@SLOW.example.com',
+                                  'd@slow.example.com', 'e@fast.example.com')
+        self.assertEqual(tasks.send_emails(msgs, {'foo': 'bar'}), 4)
+        self.assertEqual([msg.to[0] for msg in mail.outbox],
+                         ['a@slow.example.com', 'b@fast.example.com', 'c@SLOW.example.com', 'e@fast.example.com'])
+
+        [(args, kwargs)] = self._apply_async_calls
+        self.assertEqual(args[0], [[msgs[3]], {'foo': 'bar'}])
+        self.assertGreater(kwargs['countdown'], 0)
+
+    @override_settings(CELERY_EMAIL_RATE_LIMITS={'*': '1/h'}, CELERY_EMAIL_RATE_LIMIT_KEY='backend')
+    def test_per_backend_limit(self):
+        self.assertEqual(tasks.send_emails(self.make_messages('a@example.com', 'b@example.org')), 1)
+        self.assertEqual(tasks.send_emails(self.make_messages('c@example.net')), 0)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(len(self._apply_async_calls), 2)
+
+    @override_settings(CELERY_EMAIL_RATE_LIMITS={'*': '1/h'}, CELERY_EMAIL_RATE_LIMIT_KEY='backend',
+                       CELERY_EMAIL_BACKENDS=['django.core.mail.backends.locmem.EmailBackend'])
+    def test_per_backend_limit_with_backends(self):
+        msg = mail.EmailMessage('test', 'body', 'from@example.com', ['a@example.com'])
+        self.assertRaises(ImproperlyConfigured, mail.get_connection().send_messages, [msg])
+        with override_settings(CELERY_EMAIL_OUTBOX=True):
+            self.assertRaises(ImproperlyConfigured, mail.get_connection().send_messages, [msg])
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+        self.assertEqual(len(self._apply_async_calls), 0)
+        self.assertRaises(ImproperlyConfigured, tasks.send_emails, self.make_messages('a@example.com'))
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(CELERY_EMAIL_RATE_LIMITS={'*': '2/h'}, CELERY_EMAIL_RATE_LIMIT_CACHE='default')
+    def test_shared_limit(self):
+        self.assertEqual(tasks.send_emails(self.make_messages('a@example.com', 'b@example.com', 'c@example.com')), 2)
+        self.assertEqual(len(self._apply_async_calls), 1)
+
+    @override_settings(CELERY_EMAIL_RATE_LIMITS={'*': '100/m'})
+    def test_deferred_messages_spread_out(self):
+        """
+        Deferred messages are due one after the other at the rate, grouped
+        per rate period, instead of all being deferred for a single token.
+        """
+        allowed, deferrals = rate_limit(self.make_messages(*['%d@example.com' % i for i in range(1000)]))
+        self.assertEqual(allowed, list(range(100)))
+        self.assertEqual([len(indexes) for countdown, indexes in deferrals], [100] * 9)
+        self.assertEqual(sorted(sum((indexes for countdown, indexes in deferrals), [])), list(range(100, 1000)))
+        countdowns = [countdown for countdown, indexes in deferrals]
+        self.assertEqual(countdowns, sorted(countdowns))
+        self.assertAlmostEqual(countdowns[0], 100 * 0.6, delta=1)
+        self.assertAlmostEqual(countdowns[-1], 900 * 0.6, delta=1)
+
+    @override_settings(CELERY_EMAIL_RATE_LIMITS={'*': '2/h'}, CELERY_EMAIL_RATE_LIMIT_CACHE='default')
+    def test_shared_limit_spreads_deferred_messages(self):
+        allowed, deferrals = rate_limit(self.make_messages(*['%d@example.com' % i for i in range(5)]))
+        self.assertEqual(allowed, [0, 1])
+        # the first two are due in the next window, the last one in the window after it
+        self.assertEqual([indexes for countdown, indexes in deferrals], [[2, 3], [4]])
+        self.assertEqual(round(deferrals[1][0] - deferrals[0][0]), 1800)
+        self.assertGreater(deferrals[0][0], 1800)
+
+    @override_settings(CELERY_EMAIL_RATE_LIMITS={'a.example.com': '1/h', 'b.example.com': '1/h'})
+    def test_deferred_message_takes_no_tokens(self):
+        """ A message deferred for one domain leaves the tokens of its other domains to other messages. """
+        msgs = [email_to_dict(mail.EmailMessage('test', 'body', 'from@example.com', to))
+                for to in (['1@a.example.com'], ['2@a.example.com', '2@b.example.com'], ['3@b.example.com'])]
+        allowed, deferrals = rate_limit(msgs)
+        self.assertEqual(allowed, [0, 2])
+        self.assertEqual([indexes for countdown, indexes in deferrals], [[1]])
+
+    def test_deferred_to_same_queue(self):
+        """ Deferred messages stay in the queue and priority of their priority lane. """
+        tasks.send_emails.push_request(delivery_info={
+            'exchange': 'email_bulk', 'routing_key': 'email_bulk', 'priority': 0, 'redelivered': False})
+        try:
+            tasks._defer(tasks.send_emails, [[], {}], 0, 10)
+        finally:
+            tasks.send_emails.pop_request()
+
+        [(args, kwargs)] = self._apply_async_calls
+        self.assertEqual(kwargs, {'countdown': 10, 'exchange': 'email_bulk', 'routing_key': 'email_bulk',
+                                  'priority': 0})
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('100/m'), (100, 60))
+        self.assertEqual(parse_rate('10/s'), (10, 1))
+        self.assertEqual(parse_rate('5'), (5, 1))
 
 
 class BackendTests(TestCase):
@@ -255,6 +1308,7 @@ class BackendTests(TestCase):
 
         def mock_delay(*args, **kwargs):
             self._delay_calls.append((args, kwargs))
+            return AsyncResult('task-%d' % len(self._delay_calls))
 
         self._old_delay = tasks.send_emails.delay
         tasks.send_emails.delay = mock_delay
@@ -304,6 +1358,324 @@ class BackendTests(TestCase):
             args, kwargs = last_task
             self.assertEqual(len(args[0]), N % chunksize)
 
+    def test_chunking_by_size(self):
+        """
+        With CELERY_EMAIL_CHUNK_MAX_BYTES, small messages are grouped up to
+        CELERY_EMAIL_CHUNK_MAX_MESSAGES while big messages get a task each.
+        """
+        small = [("small", "body", "from@example.com", ["to@example.com"]) for _ in range(6)]
+        big = [("big", "x" * 2000, "from@example.com", ["to@example.com"]) for _ in range(2)]
+
+        with override_settings(CELERY_EMAIL_CHUNK_SIZE=2, CELERY_EMAIL_CHUNK_MAX_BYTES=1000,
+                               CELERY_EMAIL_CHUNK_MAX_MESSAGES=5):
+            mail.send_mass_mail(small + big)
+
+        self.assertEqual([len(args[0]) for args, kwargs in self._delay_calls], [5, 1, 1, 1])
+
+    @override_settings(CELERY_EMAIL_CHUNK_SIZE=2, CELERY_EMAIL_BULK_PUBLISH=True)
+    def test_bulk_publish(self):
+        """ With CELERY_EMAIL_BULK_PUBLISH all chunks are published with one producer. """
+        calls = []
+
+        def mock_apply_async(args, producer=None, **kwargs):
+            calls.append((args, producer))
+            return AsyncResult('task-%d' % len(calls))
+
+        old_apply_async = tasks.send_emails.apply_async
+        tasks.send_emails.apply_async = mock_apply_async
+        try:
+            results = mail.send_mass_mail([
+                ("subject", "body", "from@example.com", ["to@example.com"])
+                for _ in range(5)
+            ])
+        finally:
+            tasks.send_emails.apply_async = old_apply_async
+
+        self.assertEqual([result.id for result in results], ['task-1', 'task-2', 'task-3'])
+        self.assertEqual(self._delay_calls, [])
+        self.assertEqual([len(args[0]) for args, producer in calls], [2, 2, 1])
+        producers = set(producer for args, producer in calls)
+        self.assertEqual(len(producers), 1)
+        self.assertIsNotNone(producers.pop())
+
+    @override_settings(CELERY_EMAIL_PRIORITY_LANES={
+        'transactional': {'chunk_size': 1, 'queue': 'email_fast'},
+        'bulk': {'chunk_size': 3, 'queue': 'email_bulk', 'priority': 0},
+    }, CELERY_EMAIL_DEFAULT_LANE='bulk')
+    def test_priority_lanes(self):
+        """
+        Messages are chunked with the chunk size of their lane and published
+        with its options. A message's 'lane' attribute wins over the lane of
+        the backend, which wins over CELERY_EMAIL_DEFAULT_LANE.
+        """
+        calls = []
+
+        def mock_apply_async(args, producer=None, **options):
+            calls.append(([message['subject'] for message in args[0]], options))
+            return AsyncResult('task-%d' % len(calls))
+
+        def message(subject, lane=None):
+            msg = mail.EmailMessage(subject, 'body', 'from@example.com', ['to@example.com'])
+            if lane:
+                msg.lane = lane
+            return msg
+
+        old_apply_async = tasks.send_emails.apply_async
+        tasks.send_emails.apply_async = mock_apply_async
+        try:
+            mail.get_connection().send_messages([
+                message('news1'), message('reset1', 'transactional'), message('news2'),
+                message('reset2', 'transactional'), message('news3'), message('news4'),
+            ])
+            mail.get_connection(lane='transactional').send_messages([message('reset3'), message('news5', 'bulk')])
+        finally:
+            tasks.send_emails.apply_async = old_apply_async
+
+        fast = {'queue': 'email_fast'}
+        bulk = {'queue': 'email_bulk', 'priority': 0}
+        self.assertEqual(calls, [
+            (['reset1'], fast), (['reset2'], fast), (['news1', 'news2', 'news3'], bulk), (['news4'], bulk),
+            (['reset3'], fast), (['news5'], bulk),
+        ])
+        self.assertEqual(self._delay_calls, [])
+
+    @override_settings(CELERY_EMAIL_PRIORITY_LANES={
+        'transactional': {'chunk_size': 1, 'queue': 'email_fast'},
+        'bulk': {'queue': 'email_bulk'},
+    }, CELERY_EMAIL_CHUNK_MAX_BYTES=100000, CELERY_EMAIL_CHUNK_MAX_MESSAGES=4)
+    def test_priority_lanes_with_max_bytes(self):
+        """
+        A lane's chunk_size stays the upper bound with CELERY_EMAIL_CHUNK_MAX_BYTES,
+        lanes without one are chunked up to CELERY_EMAIL_CHUNK_MAX_MESSAGES.
+        """
+        msgs = []
+        for i in range(5):
+            for lane in ('transactional', 'bulk'):
+                msg = mail.EmailMessage('%s %d' % (lane, i), 'body', 'from@example.com', ['to@example.com'])
+                msg.lane = lane
+                msgs.append(msg)
+
+        chunks = [(lane, indexes) for lane, indexes, chunk in mail.get_connection().lane_chunks(msgs)]
+        self.assertEqual(chunks, [
+            ('transactional', [0]), ('transactional', [2]), ('transactional', [4]), ('transactional', [6]),
+            ('bulk', [1, 3, 5, 7]), ('transactional', [8]), ('bulk', [9]),
+        ])
+
+    @override_settings(CELERY_EMAIL_PRIORITY_LANES={'bulk': {'chunk_size': 100}})
+    def test_unknown_priority_lane(self):
+        with self.assertRaises(ImproperlyConfigured):
+            mail.get_connection(lane='urgent').send_messages([
+                mail.EmailMessage('subject', 'body', 'from@example.com', ['to@example.com'])])
+
+    def test_stream_messages(self):
+        """
+        stream_messages publishes chunks while the messages are generated and
+        only returns a summary.
+        """
+        produced = []
+
+        def generate():
+            for i in range(7):
+                produced.append(i)
+                yield mail.EmailMessage('subject %d' % i, 'body', 'from@example.com', ['to@example.com'])
+
+        published_after = []
+
+        def mock_delay(*args, **kwargs):
+            published_after.append(len(produced))
+            self._delay_calls.append((args, kwargs))
+            return AsyncResult('task-%d' % len(self._delay_calls))
+        tasks.send_emails.delay = mock_delay
+
+        with override_settings(CELERY_EMAIL_CHUNK_SIZE=3):
+            summary = mail.get_connection().stream_messages(generate())
+
+        self.assertEqual(published_after, [3, 6, 7])
+        self.assertEqual(summary, {
+            'messages': 7,
+            'chunks': 3,
+            'scheduled': 0,
+            'first_task_id': 'task-1',
+            'last_task_id': 'task-3',
+        })
+
+
+@override_settings(CELERY_EMAIL_OUTBOX=True)
+class OutboxTests(TransactionTestCase):
+    """
+    Tests that with CELERY_EMAIL_OUTBOX messages are written to the outbox
+    table and sent once drain_outbox publishes them.
+    """
+    def setUp(self):
+        super(OutboxTests, self).setUp()
+        celery.current_app.conf.task_always_eager = True
+
+        self._drain_calls = []
+        self._old_delay = tasks.drain_outbox.delay
+        tasks.drain_outbox.delay = lambda: self._drain_calls.append(None)
+
+    def tearDown(self):
+        super(OutboxTests, self).tearDown()
+        celery.current_app.conf.task_always_eager = False
+        tasks.drain_outbox.delay = self._old_delay
+
+    def test_outbox(self):
+        kwargs = {'auth_user': 'user', 'auth_password': 'pass'}
+        written = mail.send_mass_mail([
+            ('test%d' % i, 'body', 'from@example.com', ['to%d@example.com' % i]) for i in range(5)
+        ], **kwargs)
+
+        self.assertEqual(written, 5)
+        self.assertEqual(OutboxMessage.objects.count(), 5)
+        self.assertEqual(json.loads(OutboxMessage.objects.first().backend_kwargs),
+                         {'username': 'user', 'password': 'pass'})
+        self.assertEqual(len(mail.outbox), 0)
+
+        with override_settings(CELERY_EMAIL_OUTBOX_BATCH_SIZE=2, CELERY_EMAIL_CHUNK_SIZE=2):
+            self.assertEqual(tasks.drain_outbox(), 5)
+
+        self.assertEqual([message.subject for message in mail.outbox], ['test%d' % i for i in range(5)])
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+        self.assertEqual(tasks.drain_outbox(), 0)
+
+    @override_settings(CELERY_EMAIL_PRIORITY_LANES={'bulk': {'queue': 'email_bulk'}})
+    def test_outbox_lane(self):
+        mail.get_connection(lane='bulk').send_messages([
+            mail.EmailMessage('subject', 'body', 'from@example.com', ['to@example.com'])])
+        self.assertEqual(OutboxMessage.objects.get().lane, 'bulk')
+
+        calls = []
+        old_apply_async = tasks.send_emails.apply_async
+
+        def mock_apply_async(args, producer=None, **options):
+            calls.append(options)
+            return AsyncResult('task-%d' % len(calls))
+        tasks.send_emails.apply_async = mock_apply_async
+        try:
+            tasks.drain_outbox()
+        finally:
+            tasks.send_emails.apply_async = old_apply_async
+        self.assertEqual(calls, [{'queue': 'email_bulk'}])
+
+    @override_settings(CELERY_EMAIL_BINARY_ATTACHMENTS=True)
+    def test_outbox_binary_attachments(self):
+        """ The outbox rows are JSON, so attachments are stored base64 encoded. """
+        msg = mail.EmailMessage('subject', 'body', 'from@example.com', ['to@example.com'])
+        msg.attach('data.bin', b'\x00\xff', 'application/octet-stream')
+        msg.send()
+        self.assertEqual(json.loads(OutboxMessage.objects.get().message)['attachments'],
+                         [['data.bin', 'AP8=', 'application/octet-stream']])
+
+    def test_drain_on_commit(self):
+        with transaction.atomic():
+            mail.send_mail('test', 'body', 'from@example.com', ['to@example.com'])
+            self.assertEqual(self._drain_calls, [])
+        self.assertEqual(self._drain_calls, [None])
+
+    def test_rollback(self):
+        """ Messages of a transaction which is rolled back are never sent. """
+        try:
+            with transaction.atomic():
+                mail.send_mail('test', 'body', 'from@example.com', ['to@example.com'])
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self._drain_calls, [])
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+
+    @override_settings(CELERY_EMAIL_OUTBOX_DRAIN_ON_COMMIT=False)
+    def test_no_drain_on_commit(self):
+        mail.send_mail('test', 'body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(self._drain_calls, [])
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+
+
+class ScheduledSendingTests(TransactionTestCase):
+    """
+    Tests that messages with a future 'send_at' time wait in the outbox
+    until drain_outbox finds them due.
+    """
+    def setUp(self):
+        super(ScheduledSendingTests, self).setUp()
+        celery.current_app.conf.task_always_eager = True
+
+        self._drain_calls = []
+        self._old_delay = tasks.drain_outbox.delay
+        tasks.drain_outbox.delay = lambda: self._drain_calls.append(None)
+
+    def tearDown(self):
+        super(ScheduledSendingTests, self).tearDown()
+        celery.current_app.conf.task_always_eager = False
+        tasks.drain_outbox.delay = self._old_delay
+
+    def make_message(self, subject, send_at=None):
+        message = mail.EmailMessage(subject, 'body', 'from@example.com', ['to@example.com'])
+        if send_at is not None:
+            message.send_at = send_at
+        return message
+
+    def test_schedule_bucket(self):
+        self.assertEqual(schedule_bucket(datetime.datetime(2020, 1, 1, 7, 59, 1), 60),
+                         datetime.datetime(2020, 1, 1, 8, 0))
+        self.assertEqual(schedule_bucket(datetime.datetime(2020, 1, 1, 8, 0), 60),
+                         datetime.datetime(2020, 1, 1, 8, 0))
+        self.assertEqual(schedule_bucket(datetime.datetime(2020, 1, 1, 23, 50), 15 * 60),
+                         datetime.datetime(2020, 1, 2, 0, 0))
+
+    @override_settings(CELERY_EMAIL_SCHEDULE_BUCKET_SECONDS=60 * 60)
+    def test_scheduled_messages_wait(self):
+        send_at = datetime.datetime.now() + datetime.timedelta(days=1)
+        results = mail.get_connection().send_messages([
+            self.make_message('now'),
+            self.make_message('later', send_at),
+            self.make_message('past', datetime.datetime.now() - datetime.timedelta(minutes=1)),
+        ])
+
+        self.assertEqual([message.subject for message in mail.outbox], ['now', 'past'])
+        self.assertEqual(results.chunk_indexes, [[0, 2]])
+        self.assertEqual(results.scheduled_indexes, [1])
+        self.assertEqual(results.message_results()[1], ('scheduled', None))
+        row = OutboxMessage.objects.get()
+        self.assertEqual(row.send_at, schedule_bucket(send_at, 60 * 60))
+        self.assertNotIn('send_at', json.loads(row.message))
+        self.assertEqual(self._drain_calls, [])
+
+    def test_drain_releases_due_messages(self):
+        tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+        mail.get_connection().send_messages([self.make_message('due', tomorrow),
+                                             self.make_message('later', tomorrow)])
+        OutboxMessage.objects.filter(message__contains='"due"').update(
+            send_at=datetime.datetime.now() - datetime.timedelta(seconds=1))
+
+        self.assertEqual(tasks.drain_outbox(), 1)
+        self.assertEqual([message.subject for message in mail.outbox], ['due'])
+        self.assertEqual(OutboxMessage.objects.get().send_at, schedule_bucket(tomorrow, 60))
+
+    @override_settings(CELERY_EMAIL_OUTBOX_BATCH_SIZE=2)
+    def test_stream_messages(self):
+        tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+        summary = mail.get_connection().stream_messages(
+            self.make_message('msg %d' % i, tomorrow if i % 2 else None) for i in range(7))
+        self.assertEqual(summary['messages'], 4)
+        self.assertEqual(summary['scheduled'], 3)
+        self.assertEqual(OutboxMessage.objects.count(), 3)
+
+    @override_settings(USE_TZ=True, TIME_ZONE='Europe/Amsterdam')
+    def test_time_zones(self):
+        send_at = datetime.datetime(2100, 1, 1, 8, 0, 30)
+        mail.get_connection().send_messages([self.make_message('naive', send_at)])
+        # naive datetimes are in the current time zone, 8am in Amsterdam is 7am UTC
+        self.assertEqual(OutboxMessage.objects.get().send_at,
+                         datetime.datetime(2100, 1, 1, 7, 1, tzinfo=datetime.timezone.utc))
+
+    @override_settings(CELERY_EMAIL_OUTBOX=True)
+    def test_outbox(self):
+        tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+        self.assertEqual(mail.get_connection().send_messages([self.make_message('later', tomorrow)]), 1)
+        self.assertEqual(OutboxMessage.objects.get().send_at, schedule_bucket(tomorrow, 60))
+        self.assertEqual(tasks.drain_outbox(), 0)
+        self.assertEqual(self._drain_calls, [])
+
 
 class ConfigTests(TestCase):
     """
@@ -315,6 +1687,171 @@ class ConfigTests(TestCase):
         self.assertEqual(tasks.send_email.delivery_mode, 1)
         self.assertEqual(tasks.send_email.rate_limit, '50/m')
 
+    def test_backend_import_is_lazy(self):
+        """ Importing the backend does not import the tasks, and with them Celery. """
+        code = ("import sys, django; django.setup(); import djcelery_email.backends; "
+                "print('djcelery_email.tasks' in sys.modules, 'celery' in sys.modules)")
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='tests.settings')
+        output = subprocess.check_output([sys.executable, '-c', code], env=env,
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output.split(), [b'False', b'False'])
+
+    def test_async_engine_loads_settings(self):
+        """ The async engine can be imported on its own and still sees our default settings. """
+        code = ("import django; django.setup(); import djcelery_email.aio; from django.conf import settings; "
+                "print(settings.CELERY_EMAIL_ASYNC_MAX_SESSIONS_PER_DOMAIN)")
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='tests.settings')
+        output = subprocess.check_output([sys.executable, '-c', code], env=env,
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output.strip(), b'2')
+
+    def test_resolved_settings_cleared(self):
+        self.assertEqual(extra_attributes(), ())
+        with override_settings(CELERY_EMAIL_MESSAGE_EXTRA_ATTRIBUTES=['extra_attribute']):
+            self.assertEqual(extra_attributes(), ('extra_attribute',))
+            self.assertIn('extra_attribute', message_attributes())
+        self.assertEqual(extra_attributes(), ())
+
+
+TEMPLATES = [{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', {
+        'body.txt': 'Hello {{ name }}, {{ greeting }}',
+        'body.html': '<p>Hello {{ name }}</p>',
+        'subject.txt': 'News for\n{{ name }}\n',
+    })]},
+}]
+
+
+@override_settings(TEMPLATES=TEMPLATES)
+class TemplatedMailTests(TestCase):
+    """
+    Tests that 'send_templated_mass_mail' queues template names and contexts
+    and that the messages are rendered by the task.
+    """
+    def setUp(self):
+        super(TemplatedMailTests, self).setUp()
+        celery.current_app.conf.task_always_eager = True
+
+    def tearDown(self):
+        super(TemplatedMailTests, self).tearDown()
+        celery.current_app.conf.task_always_eager = False
+
+    def test_render_on_worker(self):
+        results = send_templated_mass_mail(
+            'body.txt', [(['jeff@example.com'], {'name': 'Jeff'}), ('walter@example.com', {'name': 'Walter'}),
+                         (['donny@example.com'], {'name': 'Donny'})],
+            from_email='from@example.com', html_template_name='body.html',
+            subject_template_name='subject.txt', context={'greeting': 'abide'}, chunk_size=2)
+
+        self.assertEqual([result.get() for result in results], [2, 1])
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail.outbox[1].to, ['walter@example.com'])
+        self.assertEqual(mail.outbox[1].subject, 'News for Walter')
+        self.assertEqual(mail.outbox[1].body, 'Hello Walter, abide')
+        self.assertEqual(list(mail.outbox[1].alternatives[0]), ['<p>Hello Walter</p>', 'text/html'])
+
+    @override_settings(CELERY_EMAIL_IDEMPOTENCY=True)
+    def test_redelivered_templated_chunk(self):
+        caches['default'].clear()
+        args = [{'template_name': 'body.txt'}, [[['jeff@example.com'], {'name': 'Jeff'}]]]
+        self.assertEqual(tasks.send_templated_emails.apply(args, task_id='task-1').get(), 1)
+        self.assertEqual(tasks.send_templated_emails.apply(args, task_id='task-1').get(), 0)
+        self.assertEqual(tasks.send_templated_emails.apply(args, task_id='task-2').get(), 1)
+        self.assertEqual(len(mail.outbox), 2)
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.EvenErrorBackend')
+    def test_failed_recipients_retried_together(self):
+        retry_calls = []
+
+        def mock_retry(*args, **kwargs):
+            retry_calls.append((args, kwargs))
+
+        old_retry = tasks.send_templated_emails.retry
+        tasks.send_templated_emails.retry = mock_retry
+        try:
+            recipients = [[['to%d@example.com' % i], {'name': i}] for i in range(4)]
+            tasks.send_templated_emails({'template_name': 'body.txt'}, recipients)
+        finally:
+            tasks.send_templated_emails.retry = old_retry
+
+        self.assertEqual([msg.body for msg in mail.outbox], ['Hello 1, ', 'Hello 3, '])
+        self.assertEqual(len(retry_calls), 1)
+        args, kwargs = retry_calls[0]
+        self.assertEqual(args[0], [{'template_name': 'body.txt'}, [recipients[0], recipients[2]], {}])
+
+
+recorded_metrics = []
+
+
+def record_metric(name, value, kind, tags):
+    recorded_metrics.append((name, value, kind, tags))
+
+
+@override_settings(CELERY_EMAIL_METRICS_HOOK='tests.tests.record_metric')
+class MetricsTests(TestCase):
+    """
+    Tests that timings and counters of the hot paths are passed to the
+    CELERY_EMAIL_METRICS_HOOK and the metric_recorded signal.
+    """
+    def setUp(self):
+        super(MetricsTests, self).setUp()
+        del recorded_metrics[:]
+
+    def metrics(self, kind=None):
+        return [(name, value) for name, value, metric_kind, tags in recorded_metrics
+                if kind is None or metric_kind == kind]
+
+    def test_enqueue_metrics(self):
+        old_delay = tasks.send_emails.delay
+        tasks.send_emails.delay = lambda *args, **kwargs: None
+        try:
+            with override_settings(CELERY_EMAIL_CHUNK_SIZE=2):
+                mail.send_mass_mail([('subject', 'body', 'from@example.com', ['to@example.com'])] * 3)
+        finally:
+            tasks.send_emails.delay = old_delay
+
+        self.assertEqual([name for name, value in self.metrics('timing')],
+                         ['serialize', 'enqueue', 'serialize', 'enqueue'])
+        self.assertEqual([name for name, value in self.metrics('size')], ['chunk_bytes', 'chunk_bytes'])
+        self.assertEqual([value for name, value in self.metrics('counter')], [2, 1])
+
+    def test_send_metrics(self):
+        tasks.send_emails([mail.EmailMessage() for _ in range(2)])
+
+        self.assertEqual([name for name, value in self.metrics('timing')],
+                         ['connection_open', 'deserialize', 'send', 'deserialize', 'send'])
+        counters = self.metrics('counter')
+        self.assertIn(('messages_sent', 2), counters)
+        self.assertIn(('messages_failed', 0), counters)
+        [(name, value, kind, tags)] = [metric for metric in recorded_metrics if metric[0] == 'connection_acquired']
+        self.assertEqual(tags, {'reused': False})
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.EvenErrorBackend')
+    def test_retry_metrics(self):
+        old_retry = tasks.send_emails.retry
+        tasks.send_emails.retry = lambda *args, **kwargs: None
+        try:
+            tasks.send_emails([mail.EmailMessage() for _ in range(4)])
+        finally:
+            tasks.send_emails.retry = old_retry
+        self.assertIn(('messages_retried', 2), self.metrics('counter'))
+
+    @override_settings(CELERY_EMAIL_METRICS_HOOK=None)
+    def test_signal(self):
+        received = []
+
+        def receiver(sender, name, value, kind, tags, **kwargs):
+            received.append(name)
+
+        metric_recorded.connect(receiver)
+        try:
+            tasks.send_emails([mail.EmailMessage()])
+        finally:
+            metric_recorded.disconnect(receiver)
+        self.assertIn('send', received)
+        self.assertEqual(recorded_metrics, [])
+
 
 class IntegrationTests(TestCase):
     # We run these tests in ALWAYS_EAGER mode, but they might as well be